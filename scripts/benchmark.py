@@ -0,0 +1,670 @@
+"""
+Micro-benchmarks for the hot paths of the training loop.  Each benchmark
+also checks that the fast path gives the same results as the reference one.
+
+    python -m scripts.benchmark env_reset --game pong
+
+"""
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+import torch
+
+from src.rlpyt_atari_env import AtariEnv
+from src.rlpyt_buffer import AsyncPrioritizedSequenceReplayFrameBufferExtended, \
+    AsyncUniformSequenceReplayFrameBufferExtended, CompressedFrames, ExtendedSequenceBatchMixin, \
+    FlatSumTree, SamplesFromReplayExt, sanitize_batch, stack_frames
+from src.algos import categorical_projection
+
+
+class _FixedDraw(np.random.RandomState):
+    """Draws ``value`` for the number of start noops and 0 for the cache slot."""
+
+    def __init__(self, value):
+        super().__init__(0)
+        self.value = value
+
+    def randint(self, low, high=None, *args, **kwargs):
+        return self.value if high is not None else 0
+
+
+def benchmark_env_reset(args):
+    """Reset cost with and without the start-state cache, with a bitwise check."""
+    for reset_cache_size in (0, args.cache_size):
+        env = AtariEnv(game=args.game, seed=args.seed, reset_cache_size=reset_cache_size)
+        start = time.time()
+        for _ in range(args.resets):
+            env.reset()
+        elapsed = time.time() - start
+        print("reset_cache_size={}: {:.0f} resets/s".format(reset_cache_size, args.resets / elapsed))
+
+    # A restored start state must match a hard reset with the same number of
+    # noops, and keep matching when stepped (without sticky actions).
+    cached = AtariEnv(game=args.game, seed=args.seed, reset_cache_size=1)
+    hard = AtariEnv(game=args.game, seed=args.seed)
+    rng = np.random.RandomState(args.seed)
+    for n_noops in range(1, cached.max_start_noops + 1):
+        cached.np_random = _FixedDraw(n_noops)
+        cached.reset()  # Fills the slot.
+        obs = cached.reset()  # Restores it.
+        assert np.array_equal(obs, hard._hard_reset(n_noops))
+        for action in rng.randint(0, cached.action_space.n, size=args.check_steps):
+            steps = [env.step(action) for env in (cached, hard)]
+            assert np.array_equal(steps[0].observation, steps[1].observation)
+            assert steps[0].reward == steps[1].reward and steps[0].done == steps[1].done
+            if steps[0].env_info.traj_done:
+                break
+    print("Restored start states match hard resets for 1..{} noops.".format(cached.max_start_noops))
+
+
+SanitizeFields = namedtuple("SanitizeFields",
+                            ["all_observation", "all_reward", "return_", "done", "done_n", "values"])
+
+
+def _sanitize_batch_loop(batch):
+    """Reference: the per-sequence loop ``sanitize_batch`` replaced."""
+    has_dones, inds = torch.max(batch.done, 0)
+    for i, (has_done, ind) in enumerate(zip(has_dones, inds)):
+        if not has_done:
+            continue
+        batch.all_observation[ind+1:, i] = batch.all_observation[ind, i]
+        batch.all_reward[ind+1:, i] = 0
+        batch.return_[ind+1:, i] = 0
+        batch.done_n[ind+1:, i] = True
+        batch.values[ind+1:, i] = 0
+    return batch
+
+
+def _first_dones(done):
+    """Index of each sequence's first done, or its length if it has none."""
+    done = done.numpy()
+    return np.where(done.any(0), done.argmax(0), len(done))
+
+
+def benchmark_sanitize(args):
+    """Replay batch sanitizing: per-sequence loop vs the vectorized mask."""
+    torch.manual_seed(args.seed)
+    T, B, L = args.batch_T, args.batch_B, args.batch_T + args.n_step + 1
+
+    def make_batch():
+        return SanitizeFields(
+            all_observation=torch.randint(0, 256, (L, B, 4, 1, 84, 84), dtype=torch.uint8),
+            all_reward=torch.randn(L, B),
+            return_=torch.randn(T, B),
+            done=torch.rand(T, B) < args.done_prob,
+            done_n=torch.rand(T, B) < args.done_prob,
+            values=torch.randn(L, B, 51),
+        )
+
+    for _ in range(args.check_batches):
+        batch = make_batch()
+        expected = _sanitize_batch_loop(SanitizeFields(*(x.clone() for x in batch)))
+        first_done = _first_dones(batch.done)
+        for x, y, z in zip(sanitize_batch(SanitizeFields(*(x.clone() for x in batch))),
+                           sanitize_batch(batch, first_done), expected):
+            assert torch.equal(x, z) and torch.equal(y, z)
+    print("Vectorized batches match the loop over {} batches.".format(args.check_batches))
+
+    batches = [make_batch() for _ in range(args.batches)]
+    first_dones = [_first_dones(batch.done) for batch in batches]  # As kept by the buffer.
+    for name, fn in (("loop", lambda batch, _: _sanitize_batch_loop(batch)),
+                     ("vectorized", lambda batch, _: sanitize_batch(batch)),
+                     ("done offsets", sanitize_batch)):
+        copies = [SanitizeFields(*(x.clone() for x in batch)) for batch in batches]
+        start = time.time()
+        for batch, first_done in zip(copies, first_dones):
+            fn(batch, first_done)
+        elapsed = time.time() - start
+        print("{}: {:.3f} ms/batch".format(name, 1000 * elapsed / args.batches))
+
+
+def benchmark_replay_frames(args):
+    """Replay frame memory and sequence reads: raw array vs CompressedFrames."""
+    envs = [AtariEnv(game=args.game, seed=args.seed, id=b) for b in range(args.B)]
+    rng = np.random.RandomState(args.seed)
+    n_frames, *frame_shape = envs[0].observation_space.shape
+    R, B = args.T + n_frames - 1, args.B
+    raw = np.zeros((R, B, *frame_shape), dtype=np.uint8)
+    compressed = CompressedFrames(R, B, frame_shape, raw.dtype, codec=args.codec,
+                                  chunk_size=args.chunk_size)
+    for env in envs:
+        env.reset()
+    n_actions = envs[0].action_space.n
+    start = time.time()
+    for t in range(R):  # Written a time step at a time, like append_samples().
+        frames = []
+        for env in envs:
+            observation, _, _, env_info = env.step(rng.randint(n_actions))
+            frames.append(observation[-1])
+            if env_info.traj_done:
+                env.reset()
+        raw[t] = frames
+        compressed[t] = np.stack(frames)
+    print("Filled {} time steps x {} envs in {:.1f}s.".format(R, B, time.time() - start))
+    print("raw: {:.1f} MB, {}: {:.1f} MB ({:.1f}x smaller)".format(
+        raw.nbytes / 1e6, args.codec, compressed.nbytes / 1e6, raw.nbytes / compressed.nbytes))
+
+    # Reads like extract_observation(): n_frames + batch_T rows of one env.
+    L = n_frames + args.batch_T
+    idxs = [(t, b) for t, b in zip(rng.randint(0, R - L, size=args.reads),
+                                   rng.randint(0, B, size=args.reads))]
+    for t, b in idxs[:args.check_reads]:
+        assert np.array_equal(raw[t:t + L, b], compressed[t:t + L, b])
+        assert np.array_equal(raw[t + np.arange(L), b], compressed[t + np.arange(L), b])
+    print("Reads match over {} sequences.".format(args.check_reads))
+    for name, frames in (("raw", raw), (args.codec, compressed)):
+        start = time.time()
+        for t, b in idxs:
+            np.array(frames[t:t + L, b])  # Copy, as the batch does.
+        elapsed = time.time() - start
+        print("{}: {:.0f} sequences/s".format(name, args.reads / elapsed))
+
+
+class _BinarySumTree:
+    """Reference: rlpyt's binary sum tree, which loops over the levels."""
+
+    def __init__(self, size):
+        self.tree_levels = int(np.ceil(np.log2(size + 1)) + 1)
+        self.tree = np.zeros(2 ** self.tree_levels - 1)
+        self.low_idx = 2 ** (self.tree_levels - 1) - 1
+
+    def find(self, random_values):
+        random_values = self.tree[0] * random_values
+        tree_idxs = np.zeros(len(random_values), dtype=np.int64)
+        for _ in range(self.tree_levels - 1):
+            tree_idxs = 2 * tree_idxs + 1
+            left_values = self.tree[tree_idxs]
+            where_right = np.where(random_values > left_values)[0]
+            tree_idxs[where_right] += 1
+            random_values[where_right] -= left_values[where_right]
+        return tree_idxs - self.low_idx
+
+    def reconstruct(self, leaf_idxs, values):
+        tree_idxs = leaf_idxs + self.low_idx
+        diffs = values - self.tree[tree_idxs]
+        self.tree[tree_idxs] = values
+        for _ in range(self.tree_levels - 1):
+            tree_idxs = (tree_idxs - 1) // 2
+            np.add.at(self.tree, tree_idxs, diffs)
+
+
+def benchmark_sum_tree(args):
+    """Priority sampling and updates: binary sum tree vs FlatSumTree."""
+    rng = np.random.RandomState(args.seed)
+    for size in args.sizes:
+        priorities = rng.rand(size) + 0.01
+        binary = _BinarySumTree(size)
+        binary.reconstruct(np.arange(size), priorities)
+        flat = FlatSumTree(T=size, B=1, off_backward=0, off_forward=0, max_fan_out=args.max_fan_out)
+        flat._set_range(0, size, priorities)
+
+        # Same leaves for the same draws, also after many updates.
+        for _ in range(args.check_iters):
+            random_values = rng.rand(args.batch_B)
+            assert np.array_equal(binary.find(random_values), flat.find(random_values))
+            leaf_idxs = np.unique(rng.randint(0, size, size=args.batch_B))
+            new_priorities = rng.rand(len(leaf_idxs)) + 0.01
+            binary.reconstruct(leaf_idxs, new_priorities)
+            flat.prev_tree_idxs = leaf_idxs
+            flat.update_batch_priorities(new_priorities)
+        assert np.isclose(flat.total, flat._levels[0].sum(), rtol=1e-12)
+
+        start = time.time()
+        for _ in range(args.iters):
+            leaf_idxs = binary.find(rng.rand(args.batch_B))
+            leaf_idxs, unique_idxs = np.unique(leaf_idxs, return_index=True)
+            binary.reconstruct(leaf_idxs, rng.rand(args.batch_B)[unique_idxs] + 0.01)
+        binary_time = time.time() - start
+        start = time.time()
+        for _ in range(args.iters):
+            flat.sample(args.batch_B)
+            flat.update_batch_priorities(rng.rand(args.batch_B) + 0.01)
+        flat_time = time.time() - start
+        print("size={:.0e}: binary {:.1f} us, flat (fan-out {}) {:.1f} us per sample+update".format(
+            size, 1e6 * binary_time / args.iters, flat.fan_out, 1e6 * flat_time / args.iters))
+    print("Flat and binary trees find the same leaves.")
+
+
+ExtractFields = namedtuple("ExtractFields", ["action", "reward", "done", "value"])
+
+
+def _extract_sequences_loop(array, T_idxs, B_idxs, T):
+    """Reference: rlpyt's per-sequence ``extract_sequences()``."""
+    sequences = np.empty(shape=(T, len(B_idxs)) + array.shape[2:], dtype=array.dtype)
+    for i, (t, b) in enumerate(zip(T_idxs, B_idxs)):
+        if t + T > len(array):  # wrap
+            m = len(array) - t
+            w = T - m
+            sequences[:m, i] = array[t:, b]
+            sequences[m:, i] = array[:w, b]
+        else:
+            sequences[:, i] = array[t:t + T, b]
+    return sequences
+
+
+def _done_offsets_reference(done, cap):
+    """Reference: steps from each time to the next done (circular), capped."""
+    offsets = np.full(done.shape, cap, dtype=np.int32)
+    for k in reversed(range(cap)):
+        offsets[np.roll(done, -k, axis=0)] = k
+    return offsets
+
+
+class _DoneWriter:
+    """Writes the dones of samples at the cursor, like rlpyt's append_samples()."""
+
+    def append_samples(self, samples):
+        T = len(samples)
+        idxs = np.arange(self.t, self.t + T) % self.T
+        self.samples.done[idxs] = samples
+        self.t = (self.t + T) % self.T
+        return T, idxs
+
+
+class _RandomSequenceBuffer(ExtendedSequenceBatchMixin, _DoneWriter):
+    """The fields of an extended sequence buffer, filled at random."""
+
+    def __init__(self, T, B, n_step_return, n_frames, value_shape, done_prob, rng, batch_T=6):
+        self.T, self.B, self.n_step_return, self.n_frames = T, B, n_step_return, n_frames
+        self.rnn_state_interval, self.t = 0, rng.randint(T)
+        self.batch_T = batch_T
+        self.samples = ExtractFields(
+            action=rng.randint(0, 18, size=(T, B)),
+            reward=rng.randn(T, B).astype(np.float32),
+            done=rng.rand(T, B) < done_prob,
+            value=rng.randn(T, B, *value_shape).astype(np.float32),
+        )
+        self.samples_return_ = rng.randn(T, B).astype(np.float32)
+        self.samples_done_n = rng.rand(T, B) < done_prob
+        self.samples_frames = rng.randint(0, 256, size=(T + n_frames - 1, B, 1, 84, 84),
+                                          dtype=np.uint8)
+        self.samples_frames[:n_frames - 1] = self.samples_frames[T:]  # As after a wrap.
+        self.frame_views = False
+        # As if all of the buffer was written before the cursor.
+        self.done_offset_cap = batch_T + n_frames
+        self.samples_done_offset = _done_offsets_reference(self.samples.done, self.done_offset_cap)
+
+    def extract_observation_loop(self, T_idxs, B_idxs, T):
+        """Reference: rlpyt's per-sequence (and per-frame) extract_observation()."""
+        observation = np.empty(shape=(T, len(B_idxs), self.n_frames) +
+            self.samples_frames.shape[2:], dtype=self.samples_frames.dtype)
+        fm1 = self.n_frames - 1
+        for i, (t, b) in enumerate(zip(T_idxs, B_idxs)):
+            if t + T > self.T:  # wrap (n_frames duplicated)
+                m = self.T - t
+                w = T - m
+                for f in range(self.n_frames):
+                    observation[:m, i, f] = self.samples_frames[t + f:t + f + m, b]
+                    observation[m:, i, f] = self.samples_frames[f:w + f, b]
+            else:
+                for f in range(self.n_frames):
+                    observation[:, i, f] = self.samples_frames[t + f:t + f + T, b]
+
+            # Populate empty (zero) frames after environment done.
+            if t - fm1 < 0 or t + T > self.T:  # Wrap.
+                done_idxs = np.arange(t - fm1, t + T) % self.T
+            else:
+                done_idxs = slice(t - fm1, t + T)
+            done_fm1 = self.samples.done[done_idxs, b]
+            if np.any(done_fm1):
+                where_done_t = np.where(done_fm1)[0] - fm1  # Might be negative...
+                for f in range(1, self.n_frames):
+                    t_blanks = where_done_t + f  # ...might be > T...
+                    t_blanks = t_blanks[(t_blanks >= 0) & (t_blanks < T)]  # ..don't let it wrap.
+                    observation[t_blanks, i, :self.n_frames - f] = 0
+        return observation
+
+    def extract_batch_loop(self, T_idxs, B_idxs, T):
+        """Reference: rlpyt's extract_batch() plus the separate values gather."""
+        s, n = self.samples, self.n_step_return
+        return dict(
+            all_observation=torch.from_numpy(self.extract_observation_loop(T_idxs, B_idxs, T + n)),
+            all_action=torch.from_numpy(_extract_sequences_loop(s.action, T_idxs - 1, B_idxs, T + n)),
+            all_reward=torch.from_numpy(_extract_sequences_loop(s.reward, T_idxs - 1, B_idxs, T + n)),
+            return_=torch.from_numpy(_extract_sequences_loop(self.samples_return_, T_idxs, B_idxs, T)),
+            done=torch.from_numpy(_extract_sequences_loop(s.done, T_idxs, B_idxs, T)),
+            done_n=torch.from_numpy(_extract_sequences_loop(self.samples_done_n, T_idxs, B_idxs, T)),
+            init_rnn_state=None,
+            values=torch.from_numpy(_extract_sequences_loop(s.value, T_idxs, B_idxs, T + n + 1)),
+            age=self.B * (self.t + self.T - T_idxs % self.T),
+        )
+
+
+def benchmark_extract_batch(args):
+    """Replay batch extraction: per-sequence loops vs the vectorized gathers."""
+    rng = np.random.RandomState(args.seed)
+    T = args.batch_T
+
+    def draw():
+        # Start at 1 or later, so the sequence of prev actions does not start
+        # at -1 (the wraparound of the tail is still covered).
+        return rng.randint(1, args.T, size=args.batch_B), rng.randint(0, args.B, size=args.batch_B)
+
+    # Many dones, to cover the blanking of frames from before them.
+    buffer = _RandomSequenceBuffer(args.T, args.B, args.n_step, 4, (args.n_actions, 51),
+                                   args.check_done_prob, rng, batch_T=T)
+    for _ in range(args.check_batches):
+        T_idxs, B_idxs = draw()
+        expected = buffer.extract_batch_loop(T_idxs, B_idxs, T)
+        fields = buffer.extract_batch_ext(T_idxs, B_idxs, T)
+        for k, v in fields.items():
+            assert v is None and expected[k] is None or \
+                np.array_equal(np.asarray(v), np.asarray(expected[k])), k
+        # The first dones from the buffer's offsets are those in the batch.
+        for x, y in zip(buffer.sanitize_batch(SamplesFromReplayExt(**fields), T_idxs, B_idxs),
+                        sanitize_batch(SamplesFromReplayExt(**expected))):
+            assert x is None and y is None or np.array_equal(np.asarray(x), np.asarray(y))
+
+    # The done offsets kept up to date by append_samples() are the reference
+    # ones, except within reach of the cursor (where nothing is sampled).
+    buffer.samples.done[:] = False
+    buffer.samples_done_offset[:] = buffer.done_offset_cap
+    for _ in range(3 * args.T // 10):
+        buffer.append_samples(rng.rand(rng.randint(1, 20), args.B) < args.check_done_prob)
+        expected = _done_offsets_reference(buffer.samples.done, buffer.done_offset_cap)
+        away = (buffer.t - np.arange(args.T)) % args.T >= buffer.done_offset_cap
+        assert np.array_equal(buffer.samples_done_offset[away], expected[away])
+    print("Vectorized batches match the loops over {} batches.".format(args.check_batches))
+
+    buffer = _RandomSequenceBuffer(args.T, args.B, args.n_step, 4, (args.n_actions, 51),
+                                   args.done_prob, rng)
+
+    idxs = [draw() for _ in range(args.batches)]
+    for name, fn in (("loops", buffer.extract_batch_loop), ("vectorized", buffer.extract_batch_ext)):
+        start = time.time()
+        for T_idxs, B_idxs in idxs:
+            fn(T_idxs, B_idxs, T)
+        elapsed = time.time() - start
+        print("{}: {:.3f} ms/batch".format(name, 1000 * elapsed / args.batches))
+
+
+def benchmark_frame_views(args):
+    """Sampled observations: stacked frames vs each frame once, stacked as views."""
+    rng = np.random.RandomState(args.seed)
+    T = args.batch_T + args.n_step
+
+    def draw():
+        return rng.randint(1, args.T, size=args.batch_B), rng.randint(0, args.B, size=args.batch_B)
+
+    buffer = _RandomSequenceBuffer(args.T, args.B, args.n_step, 4, (args.n_actions, 51),
+                                   args.check_done_prob, rng)
+    for _ in range(args.check_batches):
+        T_idxs, B_idxs = draw()
+        expected = buffer.extract_observation_loop(T_idxs, B_idxs, T)
+        assert np.array_equal(stack_frames(buffer.extract_frame_stack(T_idxs, B_idxs, T)), expected)
+        # Also after sanitizing, which repeats observations after a done.
+        batches = []
+        for frame_views in (False, True):
+            buffer.frame_views = frame_views
+            batches.append(sanitize_batch(SamplesFromReplayExt(
+                **buffer.extract_batch_ext(T_idxs, B_idxs, args.batch_T))))
+        assert np.array_equal(batches[0].all_observation, stack_frames(batches[1].all_observation))
+    print("Frame stacks match the stacked observations over {} batches.".format(args.check_batches))
+
+    buffer = _RandomSequenceBuffer(args.T, args.B, args.n_step, 4, (args.n_actions, 51),
+                                   args.done_prob, rng)
+    idxs = [draw() for _ in range(args.batches)]
+    for name, extract in (("stacked", buffer.extract_observation),
+                          ("frame views", buffer.extract_frame_stack)):
+        start = time.time()
+        for T_idxs, B_idxs in idxs:
+            observation = extract(T_idxs, B_idxs, T)
+        elapsed = time.time() - start
+        n_bytes = sum(x.nbytes for x in observation) if isinstance(observation, tuple) \
+            else observation.nbytes
+        print("{}: {:.3f} ms/batch, {:.1f} MB/batch".format(name, 1000 * elapsed / args.batches,
+                                                          n_bytes / 1e6))
+
+
+class _RandomUniformBuffer(_RandomSequenceBuffer, AsyncUniformSequenceReplayFrameBufferExtended):
+    """Random buffer sampled like the uniform extended buffer."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.idxs = None  # Fixed (T_idxs, B_idxs) to return, for the check.
+
+    def _async_pull(self):
+        pass
+
+    def sample_idxs(self, batch_B, batch_T):
+        if self.idxs is not None:
+            return self.idxs
+        return (np.random.randint(1, self.T - batch_T - self.n_step_return, size=batch_B),
+                np.random.randint(0, self.B, size=batch_B))
+
+
+class _RlpytObservationLoop:
+    """rlpyt's ``extract_observation()``, behind the mixin's (for frames which are not an array)."""
+
+    def extract_observation(self, T_idxs, B_idxs, T):
+        return self.extract_observation_loop(T_idxs, B_idxs, T)
+
+
+class _CompressedUniformBuffer(_RandomUniformBuffer, _RlpytObservationLoop):
+    """Random uniform buffer with its frames in ``CompressedFrames``."""
+
+    def __init__(self, *args, codec="lz4", **kwargs):
+        super().__init__(*args, **kwargs)
+        frames = self.samples_frames
+        self.samples_frames = CompressedFrames(len(frames), self.B, frames.shape[2:], frames.dtype,
+                                               codec=codec)
+        for t, frame in enumerate(frames):  # In time order, like append_samples().
+            self.samples_frames[t] = frame
+
+
+class _RandomPrioritizedBuffer(_RandomSequenceBuffer, AsyncPrioritizedSequenceReplayFrameBufferExtended):
+    """Random buffer sampled like the prioritized extended buffer."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.beta, self.unique = 0.4, False
+        self.priority_tree = FlatSumTree(self.T, self.B, off_backward=0, off_forward=0)
+        self.priority_tree._set_range(self.B, (self.T - 20) * self.B,
+                                      np.random.rand((self.T - 21) * self.B) + 0.01)
+        self.pending_tree_idxs = deque()
+
+    def _async_pull(self):
+        pass
+
+
+def benchmark_sample_batches(args):
+    """Replay sampling for K updates: K sample_batch() calls vs sample_batches(K)."""
+    rng = np.random.RandomState(args.seed)
+    np.random.seed(args.seed)
+    K, batch_B = args.K, args.batch_B
+    kwargs = dict(T=args.T, B=args.B, n_step_return=args.n_step, n_frames=4,
+                  value_shape=(args.n_actions, 51), done_prob=args.done_prob, rng=rng,
+                  batch_T=args.batch_T)
+
+    def assert_batches_equal(x, y):
+        if isinstance(x, tuple):
+            for x_i, y_i in zip(x, y):
+                assert_batches_equal(x_i, y_i)
+        else:
+            assert x is None and y is None or torch.equal(x, y)
+
+    # Batch k of the K drawn together is the batch of its own indices.
+    uniform = _RandomUniformBuffer(**kwargs)
+    prioritized = _RandomPrioritizedBuffer(**kwargs)
+    for frame_views in (False, True):
+        uniform.frame_views = prioritized.frame_views = frame_views
+        T_idxs, B_idxs = uniform.sample_idxs(K * batch_B, args.batch_T)
+        uniform.idxs = T_idxs, B_idxs
+        batches = uniform.sample_batches(K, batch_B)
+        for k, batch in enumerate(batches):
+            uniform.idxs = T_idxs[k * batch_B:(k + 1) * batch_B], B_idxs[k * batch_B:(k + 1) * batch_B]
+            assert_batches_equal(batch, uniform.sample_batch(batch_B))
+        uniform.idxs = None
+        # Prioritized batches come with the tree indices and weights of their samples.
+        tree = prioritized.priority_tree
+        for batch in prioritized.sample_batches(K, batch_B):
+            tree_idxs = prioritized.pending_tree_idxs.popleft()
+            T_idxs, B_idxs = tree_idxs // args.B, tree_idxs % args.B
+            expected = SamplesFromReplayExt(**prioritized.extract_batch_ext(T_idxs, B_idxs,
+                                                                            args.batch_T))
+            expected = prioritized.sanitize_batch(expected, T_idxs, B_idxs)
+            assert_batches_equal(tuple(getattr(batch, name) for name in expected._fields), expected)
+            is_weights = (1. / (tree.priorities.reshape(-1)[tree_idxs] + 1e-5)) ** prioritized.beta
+            assert np.allclose(batch.is_weights.numpy(), is_weights / is_weights.max())
+    uniform.frame_views = prioritized.frame_views = False
+    # Compressed frames go through rlpyt's loop, over the K batches at once.
+    compressed = _CompressedUniformBuffer(**dict(kwargs, T=min(args.T, 2000)))
+    T_idxs, B_idxs = compressed.sample_idxs(K * batch_B, args.batch_T)
+    compressed.idxs = T_idxs, B_idxs
+    batches = compressed.sample_batches(K, batch_B)
+    for k, batch in enumerate(batches):
+        compressed.idxs = T_idxs[k * batch_B:(k + 1) * batch_B], B_idxs[k * batch_B:(k + 1) * batch_B]
+        assert_batches_equal(batch, compressed.sample_batch(batch_B))
+    print("Batches drawn together match their separate extraction (also from compressed frames).")
+
+    for name, buffer in (("uniform", uniform), ("prioritized", prioritized)):
+        for method in ("sample_batch", "sample_batches"):
+            start = time.time()
+            for _ in range(args.iters):
+                if method == "sample_batch":
+                    for _ in range(K):
+                        buffer.sample_batch(batch_B)
+                else:
+                    buffer.sample_batches(K, batch_B)
+                buffer.pending_tree_idxs = deque()
+            elapsed = time.time() - start
+            print("{} {}: {:.3f} ms/batch".format(name, method, 1000 * elapsed / (args.iters * K)))
+
+
+def _dense_projection(next_p, next_z, z, delta_z):
+    """Reference: the dense [B,P,P'] projection ``categorical_projection`` replaced."""
+    abs_diff_on_delta = abs(next_z.unsqueeze(1) - z.view(1, -1, 1)) / delta_z
+    projection_coeffs = torch.clamp(1 - abs_diff_on_delta, 0, 1)  # [B,P,P']
+    return (next_p.unsqueeze(1) * projection_coeffs).sum(-1)
+
+
+def benchmark_projection(args):
+    """Categorical projection of the target distributions: dense vs scatter_add_."""
+    torch.manual_seed(args.seed)
+    z = torch.linspace(args.V_min, args.V_max, args.n_atoms)
+    delta_z = (args.V_max - args.V_min) / (args.n_atoms - 1)
+
+    def make_targets():
+        # As in dist_rl_loss(), with some terminal steps and clamped returns.
+        next_p = torch.softmax(torch.randn(args.batch_B, args.n_atoms), -1)
+        done_n = torch.rand(args.batch_B) < 0.2
+        ret = args.V_max * 1.5 * (2 * torch.rand(args.batch_B, 1) - 1)
+        ret[::4] = ret[::4].round()  # Returns on atoms.
+        next_z = torch.ger(1 - done_n.float(), z * args.discount)
+        return next_p, torch.clamp(ret + next_z, args.V_min, args.V_max)
+
+    max_err = 0
+    for _ in range(args.check_batches):
+        next_p, next_z = make_targets()
+        expected = _dense_projection(next_p, next_z, z, delta_z)
+        target_p = categorical_projection(next_p, next_z, args.V_min, delta_z)
+        max_err = max(max_err, (target_p - expected).abs().max().item())
+        assert torch.allclose(target_p.sum(-1), torch.ones(args.batch_B), atol=1e-5)
+    assert max_err < 1e-5, max_err
+    print("Projections match the dense one over {} batches (max abs error {:.1e}).".format(
+        args.check_batches, max_err))
+
+    targets = [make_targets() for _ in range(args.batches)]
+    for name, fn in (("dense", lambda p, nz: _dense_projection(p, nz, z, delta_z)),
+                     ("scatter_add_", lambda p, nz: categorical_projection(p, nz, args.V_min,
+                                                                          delta_z))):
+        start = time.time()
+        for next_p, next_z in targets:
+            fn(next_p, next_z)
+        elapsed = time.time() - start
+        print("{}: {:.3f} ms/batch".format(name, 1000 * elapsed / args.batches))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--seed', type=int, default=0)
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    env_reset = subparsers.add_parser('env_reset', help=benchmark_env_reset.__doc__)
+    env_reset.add_argument('--game', default='pong')
+    env_reset.add_argument('--resets', type=int, default=1000)
+    env_reset.add_argument('--cache-size', type=int, default=4)
+    env_reset.add_argument('--check-steps', type=int, default=500)
+    env_reset.set_defaults(func=benchmark_env_reset)
+
+    sanitize = subparsers.add_parser('sanitize', help=benchmark_sanitize.__doc__)
+    sanitize.add_argument('--batch-T', type=int, default=6)
+    sanitize.add_argument('--batch-B', type=int, default=32)
+    sanitize.add_argument('--n-step', type=int, default=10)
+    sanitize.add_argument('--done-prob', type=float, default=0.05)
+    sanitize.add_argument('--batches', type=int, default=20)
+    sanitize.add_argument('--check-batches', type=int, default=20)
+    sanitize.set_defaults(func=benchmark_sanitize)
+
+    replay_frames = subparsers.add_parser('replay_frames', help=benchmark_replay_frames.__doc__)
+    replay_frames.add_argument('--game', default='pong')
+    replay_frames.add_argument('--codec', default='lz4', choices=['lz4', 'zlib'])
+    replay_frames.add_argument('--chunk-size', type=int, default=16)
+    replay_frames.add_argument('--T', type=int, default=2000)
+    replay_frames.add_argument('--B', type=int, default=4)
+    replay_frames.add_argument('--batch-T', type=int, default=16)
+    replay_frames.add_argument('--reads', type=int, default=2000)
+    replay_frames.add_argument('--check-reads', type=int, default=500)
+    replay_frames.set_defaults(func=benchmark_replay_frames)
+
+    sum_tree = subparsers.add_parser('sum_tree', help=benchmark_sum_tree.__doc__)
+    sum_tree.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000, 10000000])
+    sum_tree.add_argument('--max-fan-out', type=int, default=64)
+    sum_tree.add_argument('--batch-B', type=int, default=32)
+    sum_tree.add_argument('--iters', type=int, default=2000)
+    sum_tree.add_argument('--check-iters', type=int, default=200)
+    sum_tree.set_defaults(func=benchmark_sum_tree)
+
+    extract_batch = subparsers.add_parser('extract_batch', help=benchmark_extract_batch.__doc__)
+    extract_batch.add_argument('--T', type=int, default=10000)
+    extract_batch.add_argument('--B', type=int, default=1)
+    extract_batch.add_argument('--batch-T', type=int, default=6)
+    extract_batch.add_argument('--batch-B', type=int, default=32)
+    extract_batch.add_argument('--n-step', type=int, default=10)
+    extract_batch.add_argument('--n-actions', type=int, default=6)
+    extract_batch.add_argument('--done-prob', type=float, default=0.01)
+    extract_batch.add_argument('--check-done-prob', type=float, default=0.1)
+    extract_batch.add_argument('--batches', type=int, default=500)
+    extract_batch.add_argument('--check-batches', type=int, default=200)
+    extract_batch.set_defaults(func=benchmark_extract_batch)
+
+    frame_views = subparsers.add_parser('frame_views', help=benchmark_frame_views.__doc__)
+    frame_views.add_argument('--T', type=int, default=10000)
+    frame_views.add_argument('--B', type=int, default=1)
+    frame_views.add_argument('--batch-T', type=int, default=6)
+    frame_views.add_argument('--batch-B', type=int, default=32)
+    frame_views.add_argument('--n-step', type=int, default=10)
+    frame_views.add_argument('--n-actions', type=int, default=6)
+    frame_views.add_argument('--done-prob', type=float, default=0.01)
+    frame_views.add_argument('--check-done-prob', type=float, default=0.1)
+    frame_views.add_argument('--batches', type=int, default=500)
+    frame_views.add_argument('--check-batches', type=int, default=100)
+    frame_views.set_defaults(func=benchmark_frame_views)
+
+    sample_batches = subparsers.add_parser('sample_batches', help=benchmark_sample_batches.__doc__)
+    sample_batches.add_argument('--K', type=int, default=8)
+    sample_batches.add_argument('--T', type=int, default=10000)
+    sample_batches.add_argument('--B', type=int, default=1)
+    sample_batches.add_argument('--batch-T', type=int, default=6)
+    sample_batches.add_argument('--batch-B', type=int, default=32)
+    sample_batches.add_argument('--n-step', type=int, default=10)
+    sample_batches.add_argument('--n-actions', type=int, default=6)
+    sample_batches.add_argument('--done-prob', type=float, default=0.05)
+    sample_batches.add_argument('--iters', type=int, default=20)
+    sample_batches.set_defaults(func=benchmark_sample_batches)
+
+    projection = subparsers.add_parser('projection', help=benchmark_projection.__doc__)
+    projection.add_argument('--batch-B', type=int, default=32)
+    projection.add_argument('--n-atoms', type=int, default=51)
+    projection.add_argument('--V-min', type=float, default=-10.)
+    projection.add_argument('--V-max', type=float, default=10.)
+    projection.add_argument('--discount', type=float, default=0.99 ** 10)
+    projection.add_argument('--batches', type=int, default=2000)
+    projection.add_argument('--check-batches', type=int, default=500)
+    projection.set_defaults(func=benchmark_projection)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -19,7 +19,8 @@ import torch
 import numpy as np
 
 from src.models import SPRCatDqnModel
-from src.rlpyt_utils import OneToOneSerialEvalCollector, SerialSampler, MinibatchRlEvalWandb
+from src.rlpyt_utils import OneToOneSerialEvalCollector, ParallelEvalCollector, SerialSampler, ParallelSampler, \
+    MinibatchRlEvalWandb
 from src.algos import SPRCategoricalDQN
 from src.agent import SPRAgent
 from src.rlpyt_atari_env import AtariEnv
@@ -32,7 +33,20 @@ def build_and_train(game="pong", run_ID=0, cuda_idx=0, args=None):
     env = AtariEnv
     config = set_config(args, game)
 
-    sampler = SerialSampler(
+    if args.sampler_workers > 0:
+        SamplerCls, sampler_kwargs = ParallelSampler, dict(n_workers=args.sampler_workers)
+    else:
+        SamplerCls, sampler_kwargs = SerialSampler, dict()
+    eval_collector_kwargs = dict()
+    if args.eval_ci_width > 0:
+        eval_collector_kwargs.update(ci_width=args.eval_ci_width, ci_metric=args.eval_ci_metric,
+                                     min_trajectories=args.eval_min_trajectories)
+    if args.eval_workers > 0:
+        eval_CollectorCls = ParallelEvalCollector
+        eval_collector_kwargs['n_workers'] = args.eval_workers
+    else:
+        eval_CollectorCls = OneToOneSerialEvalCollector
+    sampler = SamplerCls(
         EnvCls=env,
         TrajInfoCls=AtariTrajInfo,  # default traj info + GameScore
         env_kwargs=config["env"],
@@ -40,10 +54,12 @@ def build_and_train(game="pong", run_ID=0, cuda_idx=0, args=None):
         batch_T=config['sampler']['batch_T'],
         batch_B=config['sampler']['batch_B'],
         max_decorrelation_steps=0,
-        eval_CollectorCls=OneToOneSerialEvalCollector,
+        eval_CollectorCls=eval_CollectorCls,
         eval_n_envs=config["sampler"]["eval_n_envs"],
         eval_max_steps=config['sampler']['eval_max_steps'],
         eval_max_trajectories=config["sampler"]["eval_max_trajectories"],
+        eval_collector_kwargs=eval_collector_kwargs,
+        **sampler_kwargs,
     )
     args.discount = config["algo"]["discount"]
     algo = SPRCategoricalDQN(optim_kwargs=config["optim"], jumps=args.jumps, **config["algo"])  # Run with defaults.
@@ -59,6 +75,9 @@ def build_and_train(game="pong", run_ID=0, cuda_idx=0, args=None):
         log_interval_steps=args.n_steps//args.num_logs,
         seed=args.seed,
         final_eval_only=args.final_eval_only,
+        async_eval=bool(args.async_eval),
+        timing=bool(args.timing),
+        timing_cuda_sync=bool(args.timing_cuda_sync),
     )
     config = dict(game=game)
     name = "dqn_" + game
@@ -77,6 +96,7 @@ if __name__ == "__main__":
     parser.add_argument('--grayscale', type=int, default=1)
     parser.add_argument('--framestack', type=int, default=4)
     parser.add_argument('--imagesize', type=int, default=84)
+    parser.add_argument('--reset-cache-size', type=int, default=0, help='Cached ALE start states per number of start noops (0: replay noops on every reset)')
     parser.add_argument('--n-steps', type=int, default=100000)
     parser.add_argument('--dqn-hidden-size', type=int, default=256)
     parser.add_argument('--target-update-interval', type=int, default=1)
@@ -84,6 +104,7 @@ if __name__ == "__main__":
     parser.add_argument('--momentum-tau', type=float, default=0.01)
     parser.add_argument('--batch-b', type=int, default=1)
     parser.add_argument('--batch-t', type=int, default=1)
+    parser.add_argument('--sampler-workers', type=int, default=0, help='Step training envs in this many subprocesses (0: serial)')
     parser.add_argument('--beluga', action="store_true")
     parser.add_argument('--jumps', type=int, default=5)
     parser.add_argument('--num-logs', type=int, default=20)
@@ -120,6 +141,20 @@ if __name__ == "__main__":
                         choices=["noisy", "value", "advantage", "relu"],
                         help='Style of q_l1 projection')
     parser.add_argument('--target-augmentation', type=int, default=1, help='Use augmentation on inputs to target networks')
+    parser.add_argument('--eval-workers', type=int, default=0, help='Run evaluation in this many subprocesses (0: in the training process)')
+    parser.add_argument('--async-eval', type=int, default=0, help='Evaluate weight snapshots in the eval workers while training continues (needs --eval-workers)')
+    parser.add_argument('--prefetch-batches', type=int, default=0, help='Replay batches to sample ahead in a background thread (0: sample synchronously)')
+    parser.add_argument('--replay-frame-codec', default=None, choices=['lz4', 'zlib'], help='Store the replay frames compressed with this codec (default: raw)')
+    parser.add_argument('--replay-dir', type=str, default='', help='Keep the replay samples in memory-mapped files in this directory (default: in memory)')
+    parser.add_argument('--replay-reopen', type=int, default=0, help='Resume from the replay last flushed to --replay-dir')
+    parser.add_argument('--flat-sum-tree', type=int, default=0, help='Use the vectorized flat sum tree for prioritized replay')
+    parser.add_argument('--replay-frame-views', type=int, default=0, help='Sample each replay frame once per sequence and stack the frames on the device')
+    parser.add_argument('--replay-sample-batches', type=int, default=1, help='Draw the replay batches of this many consecutive updates together')
+    parser.add_argument('--timing', type=int, default=0, help='Log per-phase timings of the training loop')
+    parser.add_argument('--timing-cuda-sync', type=int, default=0, help='Synchronize CUDA at phase boundaries when timing')
+    parser.add_argument('--eval-ci-width', type=float, default=0., help='Stop evaluation once the 95%% confidence interval of the mean score is this wide (0: run all episodes)')
+    parser.add_argument('--eval-ci-metric', default='GameScore', choices=['GameScore', 'GameScoreNormalized'])
+    parser.add_argument('--eval-min-trajectories', type=int, default=10, help='Minimum number of eval episodes with --eval-ci-width')
     parser.add_argument('--eval-augmentation', type=int, default=0, help='Use augmentation on inputs at evaluation time')
     parser.add_argument('--reward-loss-weight', type=float, default=0.)
     parser.add_argument('--model-rl-weight', type=float, default=0.)
@@ -144,7 +179,19 @@ if __name__ == "__main__":
     parser.add_argument('--repeat_type', type=int, default=0, help='using different method for deciding action repeat')
     parser.add_argument('--repeat_coefficient', type=float, default=1.0,
                         help='the coefficient for calculating the probability for action repeat')
+    parser.add_argument('--hash_count_latent', type=str, default="clean", choices=["clean", "augmented"],
+                        help='update the hash counts with an extra forward of the clean observations (as '
+                             'queried when acting), or with the augmented latents of the training forward')
+
+    # augmentation policy (update_et / update_shift_et)
+    parser.add_argument('--aug_policy_update', type=str, default="forward", choices=["forward", "training"],
+                        help='reward the augmentation policy with the Q-values of an extra forward after each '
+                             'optimizer step, or of the training forward')
+    parser.add_argument('--aug_policy_interval', type=int, default=1,
+                        help='update the augmentation policy every this many updates')
     args = parser.parse_args()
+    if args.eval_ci_width > 0 and args.eval_workers > 0:
+        parser.error('--eval-ci-width needs all eval envs in one collector: it cannot be used with --eval-workers')
     
     os.environ['WANDB_MODE'] = 'offline'
     if args.public:
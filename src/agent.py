@@ -19,17 +19,33 @@ class SPRAgent(AtariCatDqnAgent):
         self.repeat_type = repeat_type
         self.log_dir = log_dir
 
-    def __call__(self, observation, prev_action, prev_reward, train=False):
-        """Returns Q-values for states/observations (with grad)."""
+    def __call__(self, observation, prev_action, prev_reward, train=False, on_device=False,
+                 return_latent=False, aug_para=None):
+        """Returns Q-values for states/observations (with grad).  Unless
+        training, they are moved to the CPU, or left on the device if
+        ``on_device``.  When training, ``return_latent`` also returns the
+        model's t=0 stem latent, and ``aug_para`` sets the augmentation of the
+        t=0 observations (for augmentation policies)."""
         if train:
             model_inputs = buffer_to((observation, prev_action, prev_reward),
                 device=self.device)
-            return self.model(*model_inputs, train=train)
+            return self.model(*model_inputs, train=train, return_latent=return_latent,
+                              aug_para=aug_para)
         else:
             prev_action = self.distribution.to_onehot(prev_action)
             model_inputs = buffer_to((observation, prev_action, prev_reward),
                 device=self.device)
-            return self.model(*model_inputs).cpu()
+            q = self.model(*model_inputs)
+            return q if on_device else q.cpu()
+
+    def target(self, observation, prev_action, prev_reward, on_device=False):
+        """Returns the target Q-values for states/observations, on the CPU,
+        or left on the device if ``on_device``."""
+        prev_action = self.distribution.to_onehot(prev_action)
+        model_inputs = buffer_to((observation, prev_action, prev_reward),
+            device=self.device)
+        target_q = self.target_model(*model_inputs)
+        return target_q if on_device else target_q.cpu()
 
     def initialize(self,
                    env_spaces,
@@ -1,14 +1,20 @@
 import torch
 
 from rlpyt.utils.collections import namedarraytuple
-from collections import namedtuple
+from collections import deque, namedtuple
 from rlpyt.algos.dqn.cat_dqn import CategoricalDQN
 from rlpyt.utils.tensor import select_at_indexes, valid_mean
+from rlpyt.utils.buffer import buffer_to
 from rlpyt.algos.utils import valid_from_done
 from rlpyt.utils.logging import logger
 from src.rlpyt_buffer import AsyncPrioritizedSequenceReplayFrameBufferExtended, \
-    AsyncUniformSequenceReplayFrameBufferExtended
+    AsyncUniformSequenceReplayFrameBufferExtended, ReplayPrefetcher, \
+    CompressedPrioritizedSequenceReplayFrameBufferExtended, \
+    CompressedUniformSequenceReplayFrameBufferExtended, \
+    MemmapPrioritizedSequenceReplayFrameBufferExtended, \
+    MemmapUniformSequenceReplayFrameBufferExtended, FrameStack, stack_frames
 from src.models import from_categorical, to_categorical
+from src.utils import PhaseTimer, ScalarAccumulator
 SamplesToBuffer = namedarraytuple("SamplesToBuffer",
     ["observation", "action", "reward", "done"])
 ModelSamplesToBuffer = namedarraytuple("SamplesToBuffer",
@@ -26,6 +32,26 @@ ModelOptInfo = namedtuple("OptInfo", ["loss", "gradNorm",
 EPS = 1e-6  # (NaN-guard)
 
 
+def categorical_projection(next_p, next_z, V_min, delta_z):
+    """
+    Projects the probabilities ``next_p`` [B,P'] of the atoms at ``next_z``
+    [B,P'] onto the fixed support ``V_min + delta_z * arange(P)``: each atom's
+    mass is split between its lower and upper neighbours in proportion to
+    closeness, and accumulated with ``scatter_add_`` (O(B*P) rather than the
+    dense [B,P,P'] projection coefficients).  Returns [B,P].
+    """
+    n_atoms = next_p.shape[-1]
+    b = ((next_z - V_min) / delta_z).clamp(0, n_atoms - 1)  # [B,P']
+    lower = b.floor()
+    upper_weight = b - lower
+    lower = lower.long()
+    upper = (lower + 1).clamp(max=n_atoms - 1)  # Its weight is 0 at the top atom.
+    target_p = torch.zeros_like(next_p)
+    target_p.scatter_add_(1, lower, next_p * (1 - upper_weight))
+    target_p.scatter_add_(1, upper, next_p * upper_weight)
+    return target_p
+
+
 class SPRCategoricalDQN(CategoricalDQN):
     """Distributional DQN with fixed probability bins for the Q-value of each
     action, a.k.a. categorical."""
@@ -39,6 +65,16 @@ class SPRCategoricalDQN(CategoricalDQN):
                  distributional=1,
                  jumps=0,
                  repeat_type=0,
+                 prefetch_batches=0,
+                 replay_frame_codec=None,
+                 replay_dir=None,
+                 replay_reopen=False,
+                 flat_sum_tree=False,
+                 replay_frame_views=False,
+                 replay_sample_batches=1,
+                 hash_count_latent="clean",
+                 aug_policy_update="forward",
+                 aug_policy_interval=1,
                  **kwargs):
         super().__init__(**kwargs)
         self.opt_info_fields = tuple(f for f in ModelOptInfo._fields)  # copy
@@ -57,8 +93,41 @@ class SPRCategoricalDQN(CategoricalDQN):
             self.rl_loss = self.dist_rl_loss
 
         self.repeat_type = repeat_type
+        # Latents counted for action repeat: of an extra forward of the clean
+        # t=0 observations (as queried when acting), or those of the training
+        # forward ("augmented", no extra encoder pass).
+        assert hash_count_latent in ("augmented", "clean")
+        self.hash_count_latent = hash_count_latent
+        # Q-values rewarding the augmentation policy (update_et/update_shift_et):
+        # those of an extra forward after the optimizer step ("forward"), or
+        # of the training forward ("training"); every aug_policy_interval updates.
+        assert aug_policy_update in ("forward", "training")
+        self.aug_policy_update = aug_policy_update
+        self.aug_policy_interval = aug_policy_interval
+        # Number of replay batches sampled ahead in a background thread.
+        self.prefetch_batches = prefetch_batches
+        # Lossless codec ('lz4' or 'zlib') for the replay frames, None for raw.
+        self.replay_frame_codec = replay_frame_codec
+        # Directory for memmapped replay samples (None: in memory), and
+        # whether to resume from the replay flushed there.
+        self.replay_dir = replay_dir
+        self.replay_reopen = replay_reopen
+        assert replay_frame_codec is None or replay_dir is None, \
+            "Compressed frames are kept in memory, not with replay_dir."
+        # Use the vectorized FlatSumTree as the priority tree.
+        self.flat_sum_tree = flat_sum_tree
+        # Sample the frames of each sequence once, and stack them on the device.
+        self.replay_frame_views = replay_frame_views
+        # Replay batches drawn together, for this many consecutive updates (with
+        # prioritized replay, batches miss the priority updates of the ones
+        # before them in the draw).
+        self.replay_sample_batches = replay_sample_batches
+        assert replay_sample_batches == 1 or prefetch_batches == 0, \
+            "Replay batches are either prefetched or drawn together."
 
         self.sum_reward = 0
+        # Replaced by the runner's timer when timing is enabled.
+        self.timer = PhaseTimer(enabled=False)
 
     def initialize_replay_buffer(self, examples, batch_spec, async_=False):
         example_to_buffer = ModelSamplesToBuffer(
@@ -76,15 +145,33 @@ class SPRCategoricalDQN(CategoricalDQN):
             discount=self.discount,
             n_step_return=self.n_step_return,
             rnn_state_interval=0,
+            frame_views=self.replay_frame_views,
         )
+        if self.replay_frame_codec is not None:
+            replay_kwargs['frame_codec'] = self.replay_frame_codec
+        if self.replay_dir is not None:
+            replay_kwargs['replay_dir'] = self.replay_dir
+            replay_kwargs['reopen'] = self.replay_reopen
 
         if self.prioritized_replay:
             replay_kwargs['alpha'] = self.pri_alpha
             replay_kwargs['beta'] = self.pri_beta_init
+            replay_kwargs['flat_sum_tree'] = self.flat_sum_tree
             # replay_kwargs["input_priorities"] = self.input_priorities
-            buffer = AsyncPrioritizedSequenceReplayFrameBufferExtended(**replay_kwargs)
+            if self.replay_frame_codec is not None:
+                buffer = CompressedPrioritizedSequenceReplayFrameBufferExtended(**replay_kwargs)
+            elif self.replay_dir is not None:
+                buffer = MemmapPrioritizedSequenceReplayFrameBufferExtended(**replay_kwargs)
+            else:
+                buffer = AsyncPrioritizedSequenceReplayFrameBufferExtended(**replay_kwargs)
+        elif self.replay_frame_codec is not None:
+            buffer = CompressedUniformSequenceReplayFrameBufferExtended(**replay_kwargs)
+        elif self.replay_dir is not None:
+            buffer = MemmapUniformSequenceReplayFrameBufferExtended(**replay_kwargs)
         else:
             buffer = AsyncUniformSequenceReplayFrameBufferExtended(**replay_kwargs)
+        if self.prefetch_batches > 0:
+            buffer = ReplayPrefetcher(buffer, self.batch_size, n_prefetch=self.prefetch_batches)
 
         self.replay_buffer = buffer
 
@@ -104,6 +191,10 @@ class SPRCategoricalDQN(CategoricalDQN):
             self.optimizer.load_state_dict(self.initial_optim_state_dict)
         if self.prioritized_replay:
             self.pri_beta_itr = max(1, self.pri_beta_steps // self.sampler_bs)
+        # Support of the value distributions.
+        self.z = torch.linspace(self.V_min, self.V_max, self.agent.n_atoms,
+                                device=self.agent.device)
+        self.delta_z = (self.V_max - self.V_min) / (self.agent.n_atoms - 1)
 
     def samples_to_buffer(self, samples):
         """Defines how to add data from sampler into the replay buffer. Called
@@ -131,7 +222,8 @@ class SPRCategoricalDQN(CategoricalDQN):
             if itr >= self.min_itr_learn:
                 self.sum_reward += samples.env.reward[0][0]
                 if samples.env.done:
-                    self.model.update_transform(self.sum_reward)
+                    with self.timer.phase("OptAugPolicy"):
+                        self.model.update_transform(self.sum_reward)
                     self.sum_reward = 0
             samples_to_buffer = self.samples_to_buffer(samples)
             self.replay_buffer.append_samples(samples_to_buffer)
@@ -139,52 +231,102 @@ class SPRCategoricalDQN(CategoricalDQN):
         if itr < self.min_itr_learn:
             return opt_info
 
-        for _ in range(self.updates_per_optimize):
-            samples_from_replay = self.replay_buffer.sample_batch(self.batch_size)
-            if self.repeat_type == 1 or self.repeat_type == 2:
-                # update the counting table
-                with torch.no_grad():
-                    feature = self.model.forward_feature(
-                        samples_from_replay.all_observation.to(self.agent.device), train=True)
+        timer = self.model.timer = self.timer  # The model times the SPR loss.
+        replay_batches = deque()
+        # The per-update scalars stay on the device until the end of the call.
+        metrics = ScalarAccumulator()
+        for i in range(self.updates_per_optimize):
+            with timer.phase("OptReplaySample"):
+                if self.replay_sample_batches > 1:
+                    if not replay_batches:
+                        replay_batches.extend(self.replay_buffer.sample_batches(
+                            min(self.replay_sample_batches, self.updates_per_optimize - i),
+                            self.batch_size))
+                    samples_from_replay = replay_batches.popleft()
+                else:
+                    samples_from_replay = self.replay_buffer.sample_batch(self.batch_size)
+                if isinstance(samples_from_replay.all_observation, FrameStack):
+                    samples_from_replay = samples_from_replay._replace(all_observation=stack_frames(
+                        samples_from_replay.all_observation, self.agent.device))
+                # The losses are computed on the device.
+                samples_from_replay = buffer_to(samples_from_replay, device=self.agent.device)
+            if (self.repeat_type == 1 or self.repeat_type == 2) and self.hash_count_latent == "clean":
+                # update the counting table (else done in loss())
+                with timer.phase("OptHashCount"), torch.no_grad():
+                    feature = self.model.forward_feature(samples_from_replay.all_observation,
+                                                         train=True)
                     self.model.hash_count.fit_before_process_samples(feature.cpu().numpy())
-
+            update_aug_policy = self.model.update_aug and \
+                self.update_counter % self.aug_policy_interval == 0
+            aug_policy = self.model.sample_aug_para() \
+                if update_aug_policy and self.aug_policy_update == "training" else None
             loss, td_abs_errors, model_rl_loss, reward_loss,\
-            t0_spr_loss, model_spr_loss = self.loss(samples_from_replay)
+            t0_spr_loss, model_spr_loss = self.loss(samples_from_replay, aug_policy)
             spr_loss = self.t0_spr_loss_weight*t0_spr_loss + self.model_spr_weight*model_spr_loss
             total_loss = loss + self.model_rl_weight*model_rl_loss \
                               + self.reward_loss_weight*reward_loss
             total_loss = total_loss + spr_loss
-            self.optimizer.zero_grad()
-            total_loss.backward()
-            grad_norm = torch.nn.utils.clip_grad_norm_(
-                self.model.stem_parameters(), self.clip_grad_norm)
-            if len(list(self.model.dynamics_model.parameters())) > 0:
-                model_grad_norm = torch.nn.utils.clip_grad_norm_(
-                    self.model.dynamics_model.parameters(), self.clip_grad_norm)
-            else:
-                model_grad_norm = 0
-            self.optimizer.step()
-
-            z = torch.linspace(self.V_min, self.V_max, self.agent.n_atoms)
-            self.agent.model.update_transform_prob(samples_from_replay,  self.distributional, self.agent.device, z)
+            with timer.phase("OptBackward"):
+                self.optimizer.zero_grad()
+                total_loss.backward()
+            with timer.phase("OptStep"):
+                grad_norm = torch.nn.utils.clip_grad_norm_(
+                    self.model.stem_parameters(), self.clip_grad_norm)
+                if len(list(self.model.dynamics_model.parameters())) > 0:
+                    model_grad_norm = torch.nn.utils.clip_grad_norm_(
+                        self.model.dynamics_model.parameters(), self.clip_grad_norm)
+                else:
+                    model_grad_norm = 0
+                self.optimizer.step()
+
+            if update_aug_policy and self.aug_policy_update == "forward":
+                with timer.phase("OptAugPolicy"):
+                    self.agent.model.update_transform_prob(samples_from_replay,  self.distributional, self.agent.device, self.z)
 
             if self.prioritized_replay:
-                self.replay_buffer.update_batch_priorities(td_abs_errors)
-            opt_info.loss.append(loss.item())
-            opt_info.gradNorm.append(torch.tensor(grad_norm).item())  # grad_norm is a float sometimes, so wrap in tensor
-            opt_info.modelRLLoss.append(model_rl_loss.item())
-            opt_info.RewardLoss.append(reward_loss.item())
-            opt_info.modelGradNorm.append(torch.tensor(model_grad_norm).item())
-            opt_info.SPRLoss.append(spr_loss.item())
-            opt_info.ModelSPRLoss.append(model_spr_loss.item())
-            opt_info.tdAbsErr.extend(td_abs_errors[::8].numpy())  # Downsample.
+                with timer.phase("OptPriorities"):
+                    # The sum tree is on the host (the only per-update sync).
+                    self.replay_buffer.update_batch_priorities(td_abs_errors.cpu())
+            metrics.append(loss=loss,
+                           gradNorm=grad_norm,
+                           modelRLLoss=model_rl_loss,
+                           RewardLoss=reward_loss,
+                           modelGradNorm=model_grad_norm,
+                           SPRLoss=spr_loss,
+                           ModelSPRLoss=model_spr_loss)
+            metrics.extend(tdAbsErr=td_abs_errors[::8])  # Downsample.
             self.update_counter += 1
             if self.update_counter % self.target_update_interval == 0:
-                self.agent.update_target(self.target_update_tau)
+                with timer.phase("OptTargetUpdate"):
+                    self.agent.update_target(self.target_update_tau)
+        for name, values in metrics.values().items():
+            getattr(opt_info, name).extend(values)
         self.update_itr_hyperparams(itr)
         return opt_info
 
-    def dqn_rl_loss(self, qs, samples, index):
+    def bootstrap_outputs(self, samples, n_indexes):
+        """
+        Target network outputs, and online ones for double DQN (else None),
+        at the bootstrap times ``index + n_step_return`` of the first
+        ``n_indexes`` indexes (t=0 and the jumps): one forward of each network
+        on all of them stacked, instead of one per index.  Returns a list of
+        ``(target, online)`` [B,A(,P')] pairs, by index.
+        """
+        times = slice(self.n_step_return, self.n_step_return + n_indexes)
+        inputs = (samples.all_observation[times].flatten(0, 1),
+                  samples.all_action[times].flatten(0, 1),
+                  samples.all_reward[times].flatten(0, 1))
+        with torch.no_grad():
+            target_out = self.agent.target(*inputs, on_device=True)
+            target_out = target_out.view(n_indexes, -1, *target_out.shape[1:])
+            if self.double_dqn:
+                online_out = self.agent(*inputs, on_device=True)
+                online_out = online_out.view(n_indexes, -1, *online_out.shape[1:])
+            else:
+                online_out = (None,) * n_indexes
+        return list(zip(target_out, online_out))
+
+    def dqn_rl_loss(self, qs, samples, index, target_qs, next_qs=None):
         """
         Computes the Q-learning loss, based on: 0.5 * (Q - target_Q) ^ 2.
         Implements regular DQN or Double-DQN for computing target_Q values
@@ -194,8 +336,9 @@ class SPRCategoricalDQN(CategoricalDQN):
 
         Input ``samples`` have leading batch dimension [B,..] (but not time).
 
-        Calls the agent to compute forward pass on training inputs, and calls
-        ``agent.target()`` to compute target values.
+        ``target_qs`` (and ``next_qs`` for double DQN) are the target (and
+        online) network outputs at ``index + n_step_return``, from
+        ``bootstrap_outputs()``.
 
         Returns loss and TD-absolute-errors for use in prioritization.
 
@@ -204,15 +347,9 @@ class SPRCategoricalDQN(CategoricalDQN):
             between iterations, so some samples in the replay buffer will be
             invalid.  This case is not supported here currently.
         """
-        q = select_at_indexes(samples.all_action[index+1], qs).cpu()
+        q = select_at_indexes(samples.all_action[index+1], qs)
         with torch.no_grad():
-            target_qs = self.agent.target(samples.all_observation[index + self.n_step_return],
-                                          samples.all_action[index + self.n_step_return],
-                                          samples.all_reward[index + self.n_step_return])  # [B,A,P']
             if self.double_dqn:
-                next_qs = self.agent(samples.all_observation[index + self.n_step_return],
-                                     samples.all_action[index + self.n_step_return],
-                                     samples.all_reward[index + self.n_step_return])  # [B,A,P']
                 next_a = torch.argmax(next_qs, dim=-1)
                 target_q = select_at_indexes(next_a, target_qs)
             else:
@@ -232,9 +369,13 @@ class SPRCategoricalDQN(CategoricalDQN):
             td_abs_errors = torch.clamp(td_abs_errors, 0, self.delta_clip)
         return losses, td_abs_errors
 
-    def dist_rl_loss(self, log_pred_ps, samples, index):
-        delta_z = (self.V_max - self.V_min) / (self.agent.n_atoms - 1)
-        z = torch.linspace(self.V_min, self.V_max, self.agent.n_atoms)
+    def dist_rl_loss(self, log_pred_ps, samples, index, target_ps, next_ps=None):
+        """
+        Cross-entropy between the predicted distributions of the sampled
+        actions and the projected targets; ``target_ps`` [B,A,P'] (and
+        ``next_ps`` for double DQN) as in ``dqn_rl_loss()``.
+        """
+        z = self.z
         # Make 2-D tensor of contracted z_domain for each data point,
         # with zeros where next value should not be added.
         next_z = z * (self.discount ** self.n_step_return)  # [P']
@@ -242,33 +383,18 @@ class SPRCategoricalDQN(CategoricalDQN):
         ret = samples.return_[index].unsqueeze(1)  # [B,1]
         next_z = torch.clamp(ret + next_z, self.V_min, self.V_max)  # [B,P']
 
-        z_bc = z.view(1, -1, 1)  # [1,P,1]
-        next_z_bc = next_z.unsqueeze(1)  # [B,1,P']
-        abs_diff_on_delta = abs(next_z_bc - z_bc) / delta_z
-        projection_coeffs = torch.clamp(1 - abs_diff_on_delta, 0, 1)  # Most 0.
-        # projection_coeffs is a 3-D tensor: [B,P,P']
-        # dim-0: independent data entries
-        # dim-1: base_z atoms (remains after projection)
-        # dim-2: next_z atoms (summed in projection)
-
         with torch.no_grad():
-            target_ps = self.agent.target(samples.all_observation[index + self.n_step_return],
-                                          samples.all_action[index + self.n_step_return],
-                                          samples.all_reward[index + self.n_step_return])  # [B,A,P']
             if self.double_dqn:
-                next_ps = self.agent(samples.all_observation[index + self.n_step_return],
-                                     samples.all_action[index + self.n_step_return],
-                                     samples.all_reward[index + self.n_step_return])  # [B,A,P']
                 next_qs = torch.tensordot(next_ps, z, dims=1)  # [B,A]
                 next_a = torch.argmax(next_qs, dim=-1)  # [B]
             else:
                 target_qs = torch.tensordot(target_ps, z, dims=1)  # [B,A]
                 next_a = torch.argmax(target_qs, dim=-1)  # [B]
             target_p_unproj = select_at_indexes(next_a, target_ps)  # [B,P']
-            target_p_unproj = target_p_unproj.unsqueeze(1)  # [B,1,P']
-            target_p = (target_p_unproj * projection_coeffs).sum(-1)  # [B,P]
+            target_p = categorical_projection(target_p_unproj, next_z,
+                                              self.V_min, self.delta_z)  # [B,P]
         p = select_at_indexes(samples.all_action[index + 1].squeeze(-1),
-                              log_pred_ps.cpu())  # [B,P]
+                              log_pred_ps)  # [B,P]
         # p = torch.clamp(p, EPS, 1)  # NaN-guard.
         losses = -torch.sum(target_p * p, dim=1)  # Cross-entropy.
 
@@ -279,62 +405,83 @@ class SPRCategoricalDQN(CategoricalDQN):
 
         return losses, KL_div.detach()
 
-    def loss(self, samples):
+    def loss(self, samples, aug_policy=None):
         """
         Computes the Distributional Q-learning loss, based on projecting the
         discounted rewards + target Q-distribution into the current Q-domain,
         with cross-entropy loss.
 
-        Returns loss and KL-divergence-errors for use in prioritization.
+        ``aug_policy`` is ``(aug_para, log_prob)`` from the model's
+        ``sample_aug_para()``: the t=0 observations are augmented with those
+        parameters, and the augmentation policy is updated from the Q-values.
+
+        Returns loss and KL-divergence-errors for use in prioritization, all
+        on the agent's device.
         """
-        if self.model.noisy:
-            self.model.head.reset_noise()
-        # start = time.time()
-        log_pred_ps, pred_rew, spr_loss\
-            = self.agent(samples.all_observation.to(self.agent.device),
-                         samples.all_action.to(self.agent.device),
-                         samples.all_reward.to(self.agent.device),
-                         train=True)  # [B,A,P]
-
-        rl_loss, KL = self.rl_loss(log_pred_ps[0], samples, 0)
-        if len(pred_rew) > 0:
-            pred_rew = torch.stack(pred_rew, 0)
-            with torch.no_grad():
-                reward_target = to_categorical(samples.all_reward[:self.jumps+1].flatten().to(self.agent.device), limit=1).view(*pred_rew.shape)
-            reward_loss = -torch.sum(reward_target * pred_rew, 2).mean(0).cpu()
-        else:
-            reward_loss = torch.zeros(samples.all_observation.shape[1],)
-        model_rl_loss = torch.zeros_like(reward_loss)
-
-        if self.model_rl_weight > 0:
-            for i in range(1, self.jumps+1):
-                    jump_rl_loss, model_KL = self.rl_loss(log_pred_ps[i],
-                                                   samples,
-                                                   i)
-                    model_rl_loss = model_rl_loss + jump_rl_loss
-
-        nonterminals = 1. - torch.sign(torch.cumsum(samples.done.to(self.agent.device), 0)).float()
-        nonterminals = nonterminals[self.model.time_offset:
-                                    self.jumps + self.model.time_offset+1]
-        spr_loss = spr_loss*nonterminals
-        if self.jumps > 0:
-            model_spr_loss = spr_loss[1:].mean(0)
-            spr_loss = spr_loss[0]
-        else:
-            spr_loss = spr_loss[0]
-            model_spr_loss = torch.zeros_like(spr_loss)
-        spr_loss = spr_loss.cpu()
-        model_spr_loss = model_spr_loss.cpu()
-        reward_loss = reward_loss.cpu()
-        if self.prioritized_replay:
-            weights = samples.is_weights
-            spr_loss = spr_loss * weights
-            model_spr_loss = model_spr_loss * weights
-            reward_loss = reward_loss * weights
-
-            # RL losses are no longer scaled in the c51 function
-            rl_loss = rl_loss * weights
-            model_rl_loss = model_rl_loss * weights
+        samples = buffer_to(samples, device=self.agent.device)  # (No-op if already there.)
+        with self.timer.phase("OptForward"):
+            if self.model.noisy:
+                self.model.head.reset_noise()
+            # start = time.time()
+            count_latent = (self.repeat_type == 1 or self.repeat_type == 2) \
+                and self.hash_count_latent == "augmented"
+            log_pred_ps, pred_rew, spr_loss, *latent\
+                = self.agent(samples.all_observation,
+                             samples.all_action,
+                             samples.all_reward,
+                             train=True,
+                             return_latent=count_latent,
+                             aug_para=None if aug_policy is None else aug_policy[0])  # [B,A,P]
+        if aug_policy is not None:
+            with self.timer.phase("OptAugPolicy"):
+                self.model.update_aug_policy(aug_policy[1], log_pred_ps[0],
+                                             self.distributional, self.z)
+        if count_latent:
+            # update the counting table with the t=0 latents of this forward
+            with self.timer.phase("OptHashCount"):
+                self.model.hash_count.fit_before_process_samples(
+                    latent[0].detach().cpu().numpy())
+        with self.timer.phase("OptTargetForward"):
+            n_indexes = self.jumps + 1 if self.model_rl_weight > 0 else 1
+            bootstrap = self.bootstrap_outputs(samples, n_indexes)
+        with self.timer.phase("OptLoss"):  # RL and reward losses (SPR's is OptSpr).
+            rl_loss, KL = self.rl_loss(log_pred_ps[0], samples, 0, *bootstrap[0])
+            if len(pred_rew) > 0:
+                pred_rew = torch.stack(pred_rew, 0)
+                with torch.no_grad():
+                    reward_target = to_categorical(samples.all_reward[:self.jumps+1].flatten(), limit=1).view(*pred_rew.shape)
+                reward_loss = -torch.sum(reward_target * pred_rew, 2).mean(0)
+            else:
+                reward_loss = torch.zeros(samples.all_observation.shape[1], device=self.agent.device)
+            model_rl_loss = torch.zeros_like(reward_loss)
+
+            if self.model_rl_weight > 0:
+                for i in range(1, self.jumps+1):
+                        jump_rl_loss, model_KL = self.rl_loss(log_pred_ps[i],
+                                                       samples,
+                                                       i,
+                                                       *bootstrap[i])
+                        model_rl_loss = model_rl_loss + jump_rl_loss
+
+            nonterminals = 1. - torch.sign(torch.cumsum(samples.done, 0)).float()
+            nonterminals = nonterminals[self.model.time_offset:
+                                        self.jumps + self.model.time_offset+1]
+            spr_loss = spr_loss*nonterminals
+            if self.jumps > 0:
+                model_spr_loss = spr_loss[1:].mean(0)
+                spr_loss = spr_loss[0]
+            else:
+                spr_loss = spr_loss[0]
+                model_spr_loss = torch.zeros_like(spr_loss)
+            if self.prioritized_replay:
+                weights = samples.is_weights
+                spr_loss = spr_loss * weights
+                model_spr_loss = model_spr_loss * weights
+                reward_loss = reward_loss * weights
+
+                # RL losses are no longer scaled in the c51 function
+                rl_loss = rl_loss * weights
+                model_rl_loss = model_rl_loss * weights
 
         return rl_loss.mean(), KL, \
                model_rl_loss.mean(),\
@@ -6,7 +6,7 @@ import torch.nn as nn
 
 from rlpyt.models.utils import scale_grad, update_state_dict
 from rlpyt.utils.tensor import infer_leading_dims, restore_leading_dims, select_at_indexes
-from src.utils import count_parameters, dummy_context_mgr
+from src.utils import count_parameters, dummy_context_mgr, CsvWriter, PhaseTimer
 import numpy as np
 from kornia.augmentation import RandomAffine,\
     RandomCrop,\
@@ -234,6 +234,8 @@ class SPRCatDqnModel(torch.nn.Module):
         self.jumps = jumps
         self.model_rl = model_rl
         self.use_spr = spr
+        # Replaced by the algo's timer, which times the SPR loss as "OptSpr".
+        self.timer = PhaseTimer(enabled=False)
         self.target_augmentation = target_augmentation
         self.eval_augmentation = eval_augmentation
         self.num_actions = output_size
@@ -571,48 +573,48 @@ class SPRCatDqnModel(torch.nn.Module):
         return processed_images
 
     def update_transform_prob(self, samples, distributional, device, z):
+        """REINFORCE step of the augmentation policy, with an extra forward
+        of the batch augmented with newly sampled parameters."""
         if self.update_aug:
-            cat = torch.distributions.categorical.Categorical(
-                torch.nn.functional.softmax(self.aug_para_prob))
-            aug_para = cat.sample()
-            if self.shift and aug_para[0] >= self.aug_para_prob.size(1) / 2:
-                log_prob = cat.log_prob(aug_para)[0]
-            else:
-                log_prob = torch.sum(cat.log_prob(aug_para))
+            aug_para, log_prob = self.sample_aug_para()
             with torch.no_grad():
                 log_pred_ps_1, pred_rew_1, spr_loss_1 = self.forward(samples.all_observation.to(device),
                            samples.all_action.to(device),
                            samples.all_reward.to(device),
                            train=True, aug_para=aug_para)
-                # log_pred_ps_2, pred_rew_2, spr_loss_2 = self.forward(samples.all_observation.to(device),
-                #                                                samples.all_action.to(device),
-                #                                                samples.all_reward.to(device),
-                #                                                train=True, aug_para=aug_para)
-            if not distributional:
-                # q1 = select_at_indexes(samples.all_action[1], log_pred_ps_1[0])
-                # q2 = select_at_indexes(samples.all_action[1], log_pred_ps_2[0])
-                # loss = log_prob*(0.5 * (q1-q2) ** 2).mean()
-
-                q = torch.max(log_pred_ps_1[0], dim=-1).values
-                loss = log_prob * (-q).mean()
-            else:
-                # p1 = select_at_indexes(samples.all_action[1].squeeze(-1),
-                #                       log_pred_ps_1[0])  # [B,P]
-                # p2 = select_at_indexes(samples.all_action[1].squeeze(-1),
-                #                       log_pred_ps_2[0])  # [B,P]
-
-                # loss = log_prob*(-torch.sum(p1 * p2, dim=1)).mean()
-
-                qs = torch.tensordot(log_pred_ps_1[0], z.to(device), dims=1)  # [B,A]
-                q = torch.max(qs, dim=-1).values  # [B]
-                loss = log_prob * (-q).mean()
-            self.aug_para_prob_optim.zero_grad()
-            loss.backward()
-            self.aug_para_prob_optim.step()
-            if self.print_count % self.print_freq == 0:
-                print('prob: ')
-                print(torch.nn.functional.softmax(self.aug_para_prob))
-            self.print_count += 1
+            self.update_aug_policy(log_prob, log_pred_ps_1[0], distributional, z)
+
+    def sample_aug_para(self):
+        """Samples augmentation parameters from the policy, and returns them
+        with their log-probability."""
+        cat = torch.distributions.categorical.Categorical(
+            torch.nn.functional.softmax(self.aug_para_prob))
+        aug_para = cat.sample()
+        if self.shift and aug_para[0] >= self.aug_para_prob.size(1) / 2:
+            log_prob = cat.log_prob(aug_para)[0]
+        else:
+            log_prob = torch.sum(cat.log_prob(aug_para))
+        return aug_para, log_prob
+
+    def update_aug_policy(self, log_prob, log_pred_ps, distributional, z):
+        """REINFORCE step of the augmentation policy, rewarding the parameters
+        of ``log_prob`` with the mean max Q-value of the t=0 outputs
+        ``log_pred_ps`` [B,A(,P)] of a forward augmented with them."""
+        log_pred_ps = log_pred_ps.detach()
+        if not distributional:
+            q = torch.max(log_pred_ps, dim=-1).values
+            loss = log_prob * (-q).mean()
+        else:
+            qs = torch.tensordot(log_pred_ps, z.to(log_pred_ps.device), dims=1)  # [B,A]
+            q = torch.max(qs, dim=-1).values  # [B]
+            loss = log_prob * (-q).mean()
+        self.aug_para_prob_optim.zero_grad()
+        loss.backward()
+        self.aug_para_prob_optim.step()
+        if self.print_count % self.print_freq == 0:
+            print('prob: ')
+            print(torch.nn.functional.softmax(self.aug_para_prob))
+        self.print_count += 1
 
     def update_transform(self, reward):
         if self.auto_aug:
@@ -631,19 +633,13 @@ class SPRCatDqnModel(torch.nn.Module):
             self.aug_idx = np.argmax([np.mean(dq) + self.c * np.sqrt(np.log(self.aug_t) / self.aug_counter[i]) for i, dq in
                                       enumerate(self.past_q)])
             if self.aug_t == 1:
-                self.auto_trans_info = np.array([last_aug_idx, reward, self.aug_t, self.aug_idx] +
-                                                [np.mean(dq) for i, dq in enumerate(self.past_q)] +
-                                                [np.mean(dq) + self.c * np.sqrt(np.log(self.aug_t) / self.aug_counter[i])
-                                                 for i, dq in enumerate(self.past_q)]).reshape(1, -1)
-            else:
-                auto_trans_info = np.array([last_aug_idx, reward, self.aug_t, self.aug_idx] +
-                                           [np.mean(dq) for i, dq in enumerate(self.past_q)]+
-                                            [np.mean(dq) + self.c * np.sqrt(np.log(self.aug_t) / self.aug_counter[i])
-                                                 for i, dq in enumerate(self.past_q)]).reshape(1, -1)
-                self.auto_trans_info = np.vstack((self.auto_trans_info, auto_trans_info))
-            header = "last_aug_idx, reward, aug_t, aug_index, q, q+c"
-            # print(wandb.run.dir)
-            np.savetxt(wandb.run.dir + "/auto_aug_info.csv", self.auto_trans_info, delimiter=",", header=header)
+                header = "last_aug_idx, reward, aug_t, aug_index, q, q+c"
+                # print(wandb.run.dir)
+                self.auto_trans_writer = CsvWriter(wandb.run.dir + "/auto_aug_info.csv", header)
+            self.auto_trans_writer.write([last_aug_idx, reward, self.aug_t, self.aug_idx] +
+                                         [np.mean(dq) for i, dq in enumerate(self.past_q)] +
+                                         [np.mean(dq) + self.c * np.sqrt(np.log(self.aug_t) / self.aug_counter[i])
+                                          for i, dq in enumerate(self.past_q)])
 
     def stem_parameters(self):
         return list(self.conv.parameters()) + list(self.head.parameters())
@@ -680,10 +676,12 @@ class SPRCatDqnModel(torch.nn.Module):
 
     def forward(self, observation,
                 prev_action, prev_reward,
-                train=False, eval=False, aug_para=None):
+                train=False, eval=False, aug_para=None, return_latent=False):
         """
         For convenience reasons with DistributedDataParallel the forward method
         has been split into two cases, one for training and one for eval.
+        With ``return_latent``, training also returns the flattened stem
+        latent of the (augmented) t=0 observations, e.g. for the hash counts.
         """
         if train:
             log_pred_ps = []
@@ -717,10 +715,13 @@ class SPRCatDqnModel(torch.nn.Module):
                                                          logits=True))
 
             if self.use_spr:
-                spr_loss = self.do_spr_loss(pred_latents, observation)
+                with self.timer.phase("OptSpr", split=True):
+                    spr_loss = self.do_spr_loss(pred_latents, observation)
             else:
                 spr_loss = torch.zeros((self.jumps + 1, observation.shape[1]), device=latent.device)
 
+            if return_latent:
+                return log_pred_ps, pred_reward, spr_loss, pred_latents[0].flatten(-3, -1)
             return log_pred_ps, pred_reward, spr_loss
 
         else:
@@ -63,6 +63,7 @@ class AtariEnv(Env):
         max_start_noops (int): upper limit for random number of noop actions after reset
         repeat_action_probability (0-1): probability for sticky actions
         horizon (int): max number of steps before timeout / ``traj_done=True``
+        reset_cache_size (int): if ``>0``, keep this many cloned ALE start states for each number of start noops and restore one on reset instead of replaying the noops (filled lazily, start distribution unchanged)
     """
 
     def __init__(self,
@@ -79,6 +80,7 @@ class AtariEnv(Env):
                  imagesize=84,
                  seed=42,
                  id=0,
+                 reset_cache_size=0,
                  ):
         save__init__args(locals(), underscore=True)
         # ALE
@@ -112,6 +114,9 @@ class AtariEnv(Env):
         self._has_fire = "FIRE" in self.get_action_meanings()
         self._has_up = "UP" in self.get_action_meanings()
         self._horizon = int(horizon)
+        # Start states per number of noops, each entry (ale_state, lives, obs).
+        self._reset_cache = [[None] * reset_cache_size for _ in range(max_start_noops)] \
+            if reset_cache_size > 0 and max_start_noops > 0 else None
         self.reset()
 
     def seed(self, seed=None, id=0):
@@ -127,19 +132,52 @@ class AtariEnv(Env):
         self.ale.setInt(b'random_seed', seed2)
 
     def reset(self):
-        """Performs hard reset of ALE game."""
+        """Performs hard reset of ALE game, or restores a cached start state
+        if ``reset_cache_size>0``."""
+        if self._reset_cache is not None:
+            return self._cached_reset()
+        return self._hard_reset()
+
+    def _hard_reset(self, n_noops=None):
         self.ale.reset_game()
         self._reset_obs()
         self._life_reset()
+        restarted = False
         if self._max_start_noops > 0:
-            for _ in range(self.np_random.randint(1, self._max_start_noops + 1)):
+            if n_noops is None:
+                n_noops = self.np_random.randint(1, self._max_start_noops + 1)
+            for _ in range(n_noops):
                 self.ale.act(0)
                 if self._check_life():
-                    self.reset()
+                    self._hard_reset()
+                    restarted = True
         self._update_obs(0)  # (don't bother to populate any frame history)
         self._step_counter = 0
+        # After a restart, not a start after n_noops noops: not to be cached.
+        self._noops_restarted = restarted
         return self.get_obs()
 
+    def _cached_reset(self):
+        """Draws the number of noops as in ``_hard_reset()``, then one of the
+        cached states for it; empty slots are filled by a hard reset (unless
+        it lost a life during the noops and restarted).  With
+        sticky actions the pool only holds ``reset_cache_size`` distinct
+        starts per noop count."""
+        n_noops = self.np_random.randint(1, self._max_start_noops + 1)
+        pool = self._reset_cache[n_noops - 1]
+        slot = self.np_random.randint(len(pool))
+        if pool[slot] is None:
+            obs = self._hard_reset(n_noops)
+            if not self._noops_restarted:  # Else it stays empty.
+                pool[slot] = (self.ale.cloneState(), self._lives, obs.copy())
+            return obs
+        state, self._lives, obs = pool[slot]
+        self.ale.restoreState(state)
+        self._reset_obs()
+        self._obs[:] = obs
+        self._step_counter = 0
+        return obs.copy()
+
     def step(self, action):
         a = self._action_set[action]
         game_score = np.array(0., dtype="float32")
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import division
+import numpy as np
 import torch
 
 from rlpyt.replays.sequence.prioritized import SamplesFromReplayPri
@@ -7,10 +8,15 @@ from rlpyt.replays.sequence.prioritized import SamplesFromReplayPri
 from rlpyt.replays.sequence.n_step import SamplesFromReplay
 from rlpyt.replays.sequence.frame import AsyncPrioritizedSequenceReplayFrameBuffer, \
     AsyncUniformSequenceReplayFrameBuffer, PrioritizedSequenceReplayFrameBuffer
-from rlpyt.utils.buffer import torchify_buffer, numpify_buffer
+from rlpyt.utils.buffer import torchify_buffer, numpify_buffer, np_mp_array
 from rlpyt.utils.collections import namedarraytuple
-from rlpyt.utils.misc import extract_sequences
+import json
+import os
 import traceback
+import threading
+import queue
+import zlib
+from collections import deque, OrderedDict
 
 PrioritizedSamples = namedarraytuple("PrioritizedSamples",
                                   ["samples", "priorities"])
@@ -20,6 +26,7 @@ SamplesFromReplayExt = namedarraytuple("SamplesFromReplayPriExt",
                                        SamplesFromReplay._fields + ("values", "age"))
 SamplesFromReplayPriExt = namedarraytuple("SamplesFromReplayPriExt",
                                        SamplesFromReplayPri._fields + ("values", "age"))
+FrameStack = namedarraytuple("FrameStack", ["frames", "frame_idxs"])
 EPS = 1e-6
 
 
@@ -38,98 +45,847 @@ def samples_to_buffer(observation, action, reward, done, policy_probs, value, pr
     else:
         return samples
 
-class AsyncUniformSequenceReplayFrameBufferExtended(AsyncUniformSequenceReplayFrameBuffer):
+def sanitize_batch(batch, first_done=None):
     """
-    Extends AsyncPrioritizedSequenceReplayFrameBuffer to return policy_logits and values too during sampling.
+    Blanks out each sampled sequence after its first done: repeats the
+    observation at the done and zeroes rewards, returns and values, with
+    ``done_n`` set.  Builds one post-done mask for the whole batch and
+    writes all masked steps of each field at once, instead of looping over
+    the sequences.  The writes go through numpy views of the (CPU) tensors,
+    as numpy fancy indexing copies whole frames much faster here.
+    ``first_done`` [B] (steps to the first done of each sequence, if known
+    from the buffer) saves finding them in ``batch.done``.
     """
-    def sample_batch(self, batch_B):
-        while True:
-            try:
-                self._async_pull()  # Updates from writers.
-                batch_T = self.batch_T
-                T_idxs, B_idxs = self.sample_idxs(batch_B, batch_T)
-                sampled_indices = True
-                if self.rnn_state_interval > 1:
-                    T_idxs = T_idxs * self.rnn_state_interval
-                batch = self.extract_batch(T_idxs, B_idxs, self.batch_T)
-
-            except Exception as _:
-                print("FAILED TO LOAD BATCH")
-                if sampled_indices:
-                    print("B_idxs:", B_idxs, flush=True)
-                    print("T_idxs:", T_idxs, flush=True)
-                    print("Batch_T:", self.batch_T, flush=True)
-                    print("Buffer T:", self.T, flush=True)
-
-            elapsed_iters = self.t + self.T - T_idxs % self.T
-            elapsed_samples = self.B*(elapsed_iters)
-            values = torch.from_numpy(extract_sequences(self.samples.value, T_idxs, B_idxs, self.batch_T+self.n_step_return+1))
-            batch = SamplesFromReplayExt(*batch, values=values, age=elapsed_samples)
-            if self.batch_T > 1:
-                batch = self.sanitize_batch(batch)
-            return batch
-
-    def sanitize_batch(self, batch):
+    if first_done is None:
         has_dones, inds = torch.max(batch.done, 0)
-        for i, (has_done, ind) in enumerate(zip(has_dones, inds)):
-            if not has_done:
-                continue
-            batch.all_observation[ind+1:, i] = batch.all_observation[ind, i]
-            batch.all_reward[ind+1:, i] = 0
-            batch.return_[ind+1:, i] = 0
-            batch.done_n[ind+1:, i] = True
-            batch.values[ind+1:, i] = 0
+        has_dones, inds = has_dones.numpy(), inds.numpy()
+    else:
+        has_dones = first_done < len(batch.done)
+        inds = np.where(has_dones, first_done, 0)
+    if not has_dones.any():
         return batch
+    observation = batch.all_observation
+    # A FrameStack repeats the observation (and its blanks) by its frame indices.
+    observations = (observation.frame_idxs,) if isinstance(observation, FrameStack) \
+        else (observation,)
+    fields = numpify_buffer(observations + (batch.all_reward, batch.return_,
+                                            batch.done_n, batch.values))
+    T = max(len(field) for field in fields)
+    post_done = (np.arange(T)[:, None] > inds) & has_dones  # [T,B]
+    t_idxs, b_idxs = np.nonzero(post_done)  # Only touch those steps.
+    for field, value in zip(fields, (None,) * len(observations) + (0, 0, True, 0)):
+        in_field = t_idxs < len(field)
+        t, b = t_idxs[in_field], b_idxs[in_field]
+        field[t, b] = field[inds[b], b] if value is None else value
+    return batch
+
+
+def stack_frames(frame_stack, device=None):
+    """
+    [T,B,n_frames,C,H,W] observations from a ``FrameStack`` on the host,
+    moved to ``device`` first (so only the unique frames are transferred).
+    Without blanks and repeats (from ``sanitize_batch()``), they are a
+    strided view of the frames, in which consecutive time steps share their
+    frames, else a gather of them (blanks are the zero frame).  This is
+    decided on the host indices, so nothing waits on the device.
+    """
+    T, B, n_frames = frame_stack.frame_idxs.shape
+    canonical = torch.equal(frame_stack.frame_idxs,
+        (torch.arange(T)[:, None, None] + torch.arange(n_frames)).expand(T, B, n_frames))
+    frames, frame_idxs = (x.to(device) for x in frame_stack)
+    if canonical:
+        stride = frames.stride()
+        return frames.as_strided((T, B, n_frames) + frames.shape[2:],
+                                 (stride[0], stride[1], stride[0]) + stride[2:])
+    # (index_select of the flat [t,b] rows, much faster than indexing by (t, b).)
+    rows = (frame_idxs * B + torch.arange(B, device=frames.device)[:, None]).view(-1)
+    return frames.flatten(0, 1).index_select(0, rows).view((T, B, n_frames) + frames.shape[2:])
+
 
+class ExtendedSequenceBatchMixin:
+    """
+    Fused ``extract_batch()`` for the extended buffers: computes the circular
+    time indices of the longest sequence once, and gathers every field, with
+    ``values`` and ``age``, by one ``np.take`` into a preallocated array per
+    field, which becomes the output tensor without a copy.  Sequences start
+    at ``T_idxs - 1`` for the previous action and reward, as in rlpyt.
+
+    With ``frame_views``, ``all_observation`` is a ``FrameStack``: the frames
+    of each sequence gathered once (instead of ``n_frames`` times), with the
+    frame index of every stacked frame (a zero frame for blanks);
+    ``stack_frames()`` turns it into the observations, on the device.
 
-class AsyncPrioritizedSequenceReplayFrameBufferExtended(AsyncPrioritizedSequenceReplayFrameBuffer):
+    ``samples_done_offset`` [T,B] holds the number of steps from each time
+    to the next done (capped at ``batch_T + n_frames``, enough for any
+    sequence start or frame stack), updated in ``append_samples()`` for the
+    new steps and those before them.  It gives the first done of each
+    sampled sequence for ``sanitize_batch()`` and the blank frames of each
+    stacked observation, without scanning the dones of the batch.
+    """
+
+    def __init__(self, frame_views=False, **kwargs):
+        super().__init__(**kwargs)
+        self.frame_views = frame_views
+        self.done_offset_cap = self.batch_T + self.n_frames
+        shape = (self.T, self.B)  # Shared like the samples, for the async writers.
+        self.samples_done_offset = np_mp_array(shape, np.int32) if getattr(self, "async_", False) \
+            else np.empty(shape, dtype=np.int32)
+        self.samples_done_offset[:] = self.done_offset_cap
+
+    def append_samples(self, samples):
+        T, idxs = super().append_samples(samples)
+        # The new steps, and the ones before them which might now see a done.
+        n_steps = min(T + self.done_offset_cap, self.T)
+        self._update_done_offsets((self.t - n_steps) % self.T, n_steps)
+        return T, idxs
+
+    def reset_done_offsets(self):
+        """Recomputes all of ``samples_done_offset``, e.g. after loading dones."""
+        self._update_done_offsets(self.t, self.T)  # Oldest to newest.
+
+    def _update_done_offsets(self, t, T):
+        """Recomputes the offsets of times t ... t + T - 1 (circular), seeing
+        the dones up to the end of that range only (the cursor follows it)."""
+        cap = self.done_offset_cap
+        t_idxs = (t + np.arange(T)) % self.T
+        steps = np.arange(T)[:, None]
+        done_steps = np.where(self.samples.done[t_idxs], steps, T + cap)  # [T,B]
+        next_done = np.minimum.accumulate(done_steps[::-1], axis=0)[::-1]
+        self.samples_done_offset[t_idxs] = np.minimum(next_done - steps, cap)
+
+    def sanitize_batch(self, batch, T_idxs, B_idxs):
+        return sanitize_batch(batch, first_done=self.samples_done_offset[T_idxs, B_idxs])
+
+    def extract_batch_ext(self, T_idxs, B_idxs, T, reuse=False):
+        """Dict of the ``SamplesFromReplay`` fields plus ``values`` and ``age``.
+        With [K,B] indices, every field gets a leading K dimension: one
+        gather for K batches, each of which (``[k]``) is contiguous.  With
+        ``reuse``, the observations are gathered into the array of the
+        previous call with ``reuse`` (a fresh one of that size costs as much
+        as the gather, in page faults): valid until the next such call."""
+        assert self.rnn_state_interval == 0, "No RNN states in the extended buffers."
+        T_idxs, B_idxs = np.asarray(T_idxs), np.asarray(B_idxs)
+        n = self.n_step_return
+        # Flat [t,b] indices of times T_idxs - 1 ... T_idxs + T + n.
+        t_idxs = (T_idxs[..., None, :] + np.arange(-1, T + n + 1)[:, None]) % self.T
+        idxs = t_idxs * self.B + B_idxs[..., None, :]
+        s = self.samples
+
+        def take(array, rows):
+            out = np.empty(idxs[..., rows, :].shape + array.shape[2:], dtype=array.dtype)
+            # (The indices are in range: 'clip' avoids buffering ``out``.)
+            np.take(array.reshape((-1,) + array.shape[2:]), idxs[..., rows, :], axis=0, out=out,
+                    mode="clip")
+            return torch.from_numpy(out)
+
+        return dict(
+            all_observation=self.extract_frame_stack(T_idxs, B_idxs, T + n, reuse)
+                if self.frame_views and isinstance(self.samples_frames, np.ndarray)
+                else torch.from_numpy(self.extract_observation(T_idxs, B_idxs, T + n, reuse)),
+            all_action=take(s.action, slice(0, T + n)),  # Starts at prev_action.
+            all_reward=take(s.reward, slice(0, T + n)),
+            return_=take(self.samples_return_, slice(1, T + 1)),
+            done=take(s.done, slice(1, T + 1)),
+            done_n=take(self.samples_done_n, slice(1, T + 1)),
+            init_rnn_state=None,
+            values=take(s.value, slice(1, T + n + 2)),
+            age=torch.from_numpy(self.B * (self.t + self.T - T_idxs % self.T)),
+        )
+
+    def extract_observation(self, T_idxs, B_idxs, T, reuse=False):
+        """
+        Vectorized rlpyt ``extract_observation()``: [T,B,C,H,W] observations
+        with the frames OLDEST to NEWEST along C, gathered by one ``np.take``
+        of the circular frame indices, and frames from before a done zeroed
+        by one boolean mask.  Frames which are not a numpy array (e.g.
+        ``CompressedFrames``) go through rlpyt's per-sequence loop, over the
+        flattened [K*B] indices for [K,B] ones.
+        """
+        T_idxs, B_idxs = np.asarray(T_idxs), np.asarray(B_idxs)
+        if not isinstance(self.samples_frames, np.ndarray):
+            observation = super().extract_observation(T_idxs.reshape(-1), B_idxs.reshape(-1), T)
+            if T_idxs.ndim == 1:
+                return observation
+            observation = observation.reshape((T,) + T_idxs.shape + observation.shape[2:])
+            return np.ascontiguousarray(np.moveaxis(observation, 0, 1))  # [K,T,B,...]
+        fm1 = self.n_frames - 1
+        frames = self.samples_frames
+        t_idxs = (T_idxs[..., None, :] + np.arange(T)[:, None]) % self.T  # [(K,)T,B]
+        # Frame f of the observation at time t is row t + f of the frames.
+        rows = t_idxs[..., None] + np.arange(self.n_frames)  # [(K,)T,B,C]
+        observation = self._empty(rows.shape + frames.shape[2:], frames.dtype, reuse)
+        np.take(frames.reshape((-1,) + frames.shape[2:]), rows * self.B + B_idxs[..., None, :, None],
+                axis=0, out=observation, mode="clip")
+
+        blank = self._frame_blanks(T_idxs, B_idxs, T)
+        if blank is not None:
+            observation.reshape(rows.shape + (-1,))[..., :fm1, :][blank] = 0
+        return observation
+
+    def extract_frame_stack(self, T_idxs, B_idxs, T, reuse=False):
+        """
+        ``FrameStack`` of the observations ``extract_observation()`` returns:
+        the T + n_frames - 1 frames of each sequence and a zero frame
+        ([T+fm1+1,B,C,H,W], frame j at row T_idx + j, or its copy at the
+        start of the buffer after the wrap) with ``frame_idxs``
+        [T,B,n_frames] = t + f, or T + fm1 (the zero frame) for blanks.
+        Equal to the stacked observations as long as the duplicated frames
+        at the start and end of the buffer agree, which they do except next
+        to the write cursor, where nothing is sampled.
+        """
+        T_idxs, B_idxs = np.asarray(T_idxs), np.asarray(B_idxs)
+        fm1 = self.n_frames - 1
+        frames = self.samples_frames
+        # (Row T + fm1 is gathered too, then zeroed: one gather into the array.)
+        rows = T_idxs[..., None, :] + np.arange(T + fm1 + 1)[:, None]  # [(K,)T+fm1+1,B]
+        rows = np.where(rows < self.T + fm1, rows, rows - self.T)
+        frames_out = self._empty(rows.shape + frames.shape[2:], frames.dtype, reuse)
+        np.take(frames.reshape((-1,) + frames.shape[2:]), rows * self.B + B_idxs[..., None, :],
+                axis=0, out=frames_out, mode="clip")
+        frames_out.reshape(rows.shape + (-1,))[..., -1, :, :] = 0
+        shape = T_idxs.shape[:-1] + (T, T_idxs.shape[-1], self.n_frames)
+        frame_idxs = np.broadcast_to((np.arange(T)[:, None] + np.arange(self.n_frames))[:, None],
+                                     shape).copy()
+        blank = self._frame_blanks(T_idxs, B_idxs, T)
+        if blank is not None:
+            frame_idxs[..., :fm1][blank] = T + fm1
+        return FrameStack(*(torch.from_numpy(x) for x in (frames_out, frame_idxs)))
+
+    def _empty(self, shape, dtype, reuse=False):
+        """``np.empty()``, or with ``reuse`` the array of the last such call
+        (if of this shape and dtype)."""
+        if not reuse:
+            return np.empty(shape, dtype=dtype)
+        out = getattr(self, "_reused_out", None)
+        if out is None or out.shape != shape or out.dtype != dtype:
+            out = self._reused_out = np.empty(shape, dtype=dtype)
+        return out
+
+    def _frame_blanks(self, T_idxs, B_idxs, T):
+        """[(K,)T,B,fm1] mask of the stacked frames to zero, None if there are none."""
+        fm1 = self.n_frames - 1
+        # Frame f at time t is blank if there was a done at any of the times
+        # t - fm1 + f ... t - 1 (i.e. since that frame, before the newest):
+        # the next done from time t - fm1 + f is less than fm1 - f steps away.
+        frame_t_idxs = (T_idxs[..., None, :, None] + np.arange(T)[:, None, None]
+                        + np.arange(-fm1, 0)) % self.T  # [(K,)T,B,fm1]
+        blank = self.samples_done_offset[frame_t_idxs, B_idxs[..., None, :, None]] \
+            < np.arange(fm1, 0, -1)
+        return blank if blank.any() else None
+
+
+def _batch_fields(fields, k):
+    """Batch k of the [K,...] fields of ``extract_batch_ext()``."""
+    return {name: None if value is None else value[k] for name, value in fields.items()}
+
+
+class AsyncUniformSequenceReplayFrameBufferExtended(ExtendedSequenceBatchMixin,
+        AsyncUniformSequenceReplayFrameBuffer):
     """
     Extends AsyncPrioritizedSequenceReplayFrameBuffer to return policy_logits and values too during sampling.
     """
     def sample_batch(self, batch_B):
-        while True:
-            try:
-                self._async_pull()  # Updates from writers.
-                (T_idxs, B_idxs), priorities = self.priority_tree.sample(
-                    batch_B, unique=self.unique)
-                sampled_indices = True
-                if self.rnn_state_interval > 1:
-                    T_idxs = T_idxs * self.rnn_state_interval
-
-                batch = self.extract_batch(T_idxs, B_idxs, self.batch_T)
-
-            except Exception as _:
-                print("FAILED TO LOAD BATCH")
-                traceback.print_exc()
-                if sampled_indices:
-                    print("B_idxs:", B_idxs, flush=True)
-                    print("T_idxs:", T_idxs, flush=True)
-                    print("Batch_T:", self.batch_T, flush=True)
-                    print("Buffer T:", self.T, flush=True)
-
-            is_weights = (1. / (priorities + 1e-5)) ** self.beta
-            is_weights /= max(is_weights)  # Normalize.
-            is_weights = torchify_buffer(is_weights).float()
-
-            elapsed_iters = self.t + self.T - T_idxs % self.T
-            elapsed_samples = self.B*(elapsed_iters)
-            values = torch.from_numpy(extract_sequences(self.samples.value, T_idxs, B_idxs, self.batch_T+self.n_step_return+1))
-            batch = SamplesFromReplayPriExt(*batch,
-                                            values=values,
-                                            is_weights=is_weights,
-                                            age=elapsed_samples)
-            if self.batch_T > 1:
-                batch = self.sanitize_batch(batch)
-            return batch
-
-    def sanitize_batch(self, batch):
-        has_dones, inds = torch.max(batch.done, 0)
-        for i, (has_done, ind) in enumerate(zip(has_dones, inds)):
-            if not has_done:
-                continue
-            batch.all_observation[ind+1:, i] = batch.all_observation[ind, i]
-            batch.all_reward[ind+1:, i] = 0
-            batch.return_[ind+1:, i] = 0
-            batch.done_n[ind+1:, i] = True
-            batch.values[ind+1:, i] = 0
+        self._async_pull()  # Updates from writers.
+        T_idxs, B_idxs = self.sample_idxs(batch_B, self.batch_T)
+        batch = SamplesFromReplayExt(**self.extract_batch_ext(T_idxs, B_idxs, self.batch_T))
+        return self.sanitize_batch(batch, T_idxs, B_idxs) if self.batch_T > 1 else batch
+
+    def sample_batches(self, K, batch_B):
+        """K batches, with the indices of all drawn at once and every field
+        gathered for all of them by one ``np.take`` into [K,...] arrays, of
+        which each batch is a contiguous view.  The observations are valid
+        until the next call (their array is reused)."""
+        self._async_pull()
+        T_idxs, B_idxs = self.sample_idxs(K * batch_B, self.batch_T)
+        T_idxs, B_idxs = T_idxs.reshape(K, batch_B), B_idxs.reshape(K, batch_B)
+        fields = self.extract_batch_ext(T_idxs, B_idxs, self.batch_T, reuse=True)
+        batches = []
+        for k in range(K):
+            batch = SamplesFromReplayExt(**_batch_fields(fields, k))
+            batches.append(self.sanitize_batch(batch, T_idxs[k], B_idxs[k])
+                           if self.batch_T > 1 else batch)
+        return batches
+
+
+class FlatSumTree:
+    """
+    Drop-in for rlpyt's ``SumTree`` (without input priorities), with batched
+    stratified sampling and batched updates as whole-array numpy ops.  The
+    tree is stored flat, leaves first, with the fewest levels for at most
+    ``max_fan_out`` children per node (e.g. 4 levels of 57 children for 10M
+    leaves, instead of 24 binary levels): sampling descends all samples one
+    level at a time (prefix sums over the children of each, as one matmul),
+    and updates recompute each touched parent exactly from its children, so
+    the sums do not drift.  Leaf ``t * B + b`` holds the
+    priority of time ``t``, env ``b``, as in rlpyt.
+    NOTE: Not in shared memory; the buffer must be written in this process.
+    """
+
+    def __init__(self, T, B, off_backward, off_forward, default_value=1, max_fan_out=64):
+        self.T, self.B = T, B
+        self.size = T * B
+        self.off_backward, self.off_forward = off_backward, off_forward
+        self.default_value = default_value
+        n_levels = 1
+        while max_fan_out ** n_levels < self.size:
+            n_levels += 1
+        self.fan_out = fan_out = max(2, int(np.ceil(self.size ** (1 / n_levels))))
+        while fan_out ** n_levels < self.size:  # Rounding.
+            self.fan_out = fan_out = fan_out + 1
+        lengths = [-(-self.size // fan_out) * fan_out]
+        while lengths[-1] > 1:
+            n_parents = lengths[-1] // fan_out
+            lengths.append(n_parents if n_parents == 1 else -(-n_parents // fan_out) * fan_out)
+        self._prefix_sum = np.triu(np.ones((fan_out, fan_out)))  # x @ it is cumsum(x).
+        self.tree = np.zeros(sum(lengths))
+        offsets = np.cumsum([0] + lengths)
+        self._levels = [self.tree[low:high] for low, high in zip(offsets[:-1], offsets[1:])]
+        self.priorities = self._levels[0][:self.size].reshape(T, B)
+        self.reset()
+
+    @classmethod
+    def from_tree(cls, tree, **kwargs):
+        """A flat tree with the parameters of (empty) rlpyt ``tree``."""
+        assert getattr(tree, "input_priorities", None) is None, \
+            "Input priorities are not supported by FlatSumTree."
+        return cls(tree.T, tree.B, tree.off_backward, tree.off_forward,
+                   default_value=tree.default_value, **kwargs)
+
+    def reset(self):
+        self.tree.fill(0)
+        self.t = 0
+        self._initial_wrap_guard = True
+        self._sampled_unique = False
+        self.prev_tree_idxs = np.zeros(0, dtype=np.int64)
+
+    @property
+    def total(self):
+        return self._levels[-1][0]
+
+    def advance(self, T, priorities=None):
+        """Cursor advances by T: turns on the default priority for the samples
+        which became valid, and zeroes the ones around the new cursor."""
+        assert priorities is None, "Input priorities are not supported by FlatSumTree."
+        t, b, f = self.t, self.off_backward, self.off_forward
+        low_on_t = (t - b) % self.T
+        high_on_t = ((t + T - b - 1) % self.T) + 1
+        low_off_t = (t + T - b) % self.T
+        high_off_t = ((t + T + f - 1) % self.T) + 1
+        if self._initial_wrap_guard:
+            low_on_t = max(f, t - b)  # Don't wrap back to end, and off_forward.
+            high_on_t = low_off_t = max(low_on_t, t + T - b)
+            if t + T - b >= f:  # Next low_on_t >= f.
+                self._initial_wrap_guard = False
+        for low, high in self._wrapped_ranges(low_on_t, high_on_t):
+            self._set_range(low * self.B, high * self.B, self.default_value)
+        for low, high in self._wrapped_ranges(low_off_t, high_off_t):
+            self._set_range(low * self.B, high * self.B, 0.)
+        self.t = (t + T) % self.T
+
+    def sample(self, n, unique=False):
+        """Stratified sample of ``n`` leaves: one uniform draw in each of
+        ``n`` equal slices of the total priority.  Returns ``(T_idxs,
+        B_idxs)`` and the priorities, and keeps the leaves for
+        ``update_batch_priorities()``."""
+        self._sampled_unique = unique
+        tree_idxs = self.find((np.arange(n) + np.random.rand(n)) / n)
+        if unique:
+            for _ in range(100):
+                tree_idxs = np.unique(tree_idxs)
+                if len(tree_idxs) >= n:
+                    break
+                tree_idxs = np.concatenate([tree_idxs,
+                                            self.find(np.random.rand(2 * (n - len(tree_idxs))))])
+            if len(tree_idxs) < n:
+                raise RuntimeError("After 100 tries, unable to get unique indexes.")
+            tree_idxs = np.random.permutation(tree_idxs)[:n]
+        self.prev_tree_idxs = tree_idxs
+        T_idxs, B_idxs = np.divmod(tree_idxs, self.B)
+        return (T_idxs, B_idxs), self._levels[0][tree_idxs]
+
+    def update_batch_priorities(self, priorities):
+        """Sets the priorities of the leaves of the last ``sample()``."""
+        tree_idxs = self.prev_tree_idxs
+        if not self._sampled_unique:  # Keep the first of duplicates, like rlpyt.
+            tree_idxs, unique_idxs = np.unique(tree_idxs, return_index=True)
+            priorities = np.asarray(priorities)[unique_idxs]
+        self._levels[0][tree_idxs] = priorities
+        for child, parent in zip(self._levels[:-1], self._levels[1:]):
+            tree_idxs = tree_idxs // self.fan_out  # Duplicates just write the same sum.
+            parent[tree_idxs] = child.reshape(-1, self.fan_out)[tree_idxs].sum(axis=1)
+
+    def find(self, random_values):
+        """Leaves at fractions ``random_values`` (in [0, 1)) of the total
+        priority, descending the tree for all values at once."""
+        values = self.total * np.asarray(random_values, dtype=np.float64)
+        rows = np.arange(len(values))
+        node_idxs = np.zeros(len(values), dtype=np.int64)
+        for level in reversed(self._levels[:-1]):
+            children = level.reshape(-1, self.fan_out)[node_idxs]  # [n,fan_out]
+            cumsums = children @ self._prefix_sum
+            # Rounding can overshoot the sum of the children: stay below it,
+            # so that the first child whose cumsum exceeds the value is nonzero.
+            values = np.minimum(values, np.nextafter(cumsums[:, -1], 0))
+            child_idxs = (cumsums <= values[:, None]).sum(axis=1)
+            values = values - np.where(child_idxs > 0, cumsums[rows, child_idxs - 1], 0.)
+            node_idxs = node_idxs * self.fan_out + child_idxs
+        return node_idxs
+
+    def _wrapped_ranges(self, low, high):
+        if low < high:
+            return [(low, high)]
+        if low > high:
+            return [(low, self.T), (0, high)]
+        return []
+
+    def _set_range(self, low, high, value):
+        """Sets leaves [low, high) to ``value`` (a scalar or array) and
+        recomputes their parents."""
+        self._levels[0][low:high] = value
+        for child, parent in zip(self._levels[:-1], self._levels[1:]):
+            low, high = low // self.fan_out, -(-high // self.fan_out)
+            parent[low:high] = child[low * self.fan_out:high * self.fan_out].reshape(
+                -1, self.fan_out).sum(axis=1)
+
+
+class AsyncPrioritizedSequenceReplayFrameBufferExtended(ExtendedSequenceBatchMixin,
+        AsyncPrioritizedSequenceReplayFrameBuffer):
+    """
+    Extends AsyncPrioritizedSequenceReplayFrameBuffer to return policy_logits and values too during sampling.
+    With ``flat_sum_tree``, the priority tree is a ``FlatSumTree``.
+    """
+    def __init__(self, flat_sum_tree=False, **kwargs):
+        super().__init__(**kwargs)
+        if flat_sum_tree:
+            self.priority_tree = FlatSumTree.from_tree(self.priority_tree)
+        self.pending_tree_idxs = deque()  # Of the batches from sample_batches().
+
+    def sample_batch(self, batch_B):
+        self._async_pull()  # Updates from writers.
+        (T_idxs, B_idxs), priorities = self.priority_tree.sample(batch_B, unique=self.unique)
+        is_weights = (1. / (priorities + 1e-5)) ** self.beta
+        is_weights /= max(is_weights)  # Normalize.
+        is_weights = torchify_buffer(is_weights).float()
+        batch = SamplesFromReplayPriExt(**self.extract_batch_ext(T_idxs, B_idxs, self.batch_T),
+                                        is_weights=is_weights)
+        return self.sanitize_batch(batch, T_idxs, B_idxs) if self.batch_T > 1 else batch
+
+    def sample_batches(self, K, batch_B):
+        """
+        K batches, with the indices of all drawn from the tree at once (in
+        random order, as the tree may return them sorted).  Their priorities
+        are only as fresh as at the draw: batch k misses the updates of the
+        k batches before it.  ``update_batch_priorities()`` must be called
+        once per batch, in order, before the next draw; the observations
+        are valid until then (their array is reused).
+        """
+        self._async_pull()
+        (T_idxs, B_idxs), priorities = self.priority_tree.sample(K * batch_B, unique=self.unique)
+        order = np.random.permutation(K * batch_B)
+        self.pending_tree_idxs.extend(np.split(self.priority_tree.prev_tree_idxs[order], K))
+        is_weights = ((1. / (priorities[order] + 1e-5)) ** self.beta).reshape(K, batch_B)
+        is_weights /= is_weights.max(axis=1, keepdims=True)  # Normalize each batch.
+        is_weights = torch.from_numpy(is_weights).float()
+        T_idxs, B_idxs = T_idxs[order].reshape(K, batch_B), B_idxs[order].reshape(K, batch_B)
+        fields = self.extract_batch_ext(T_idxs, B_idxs, self.batch_T, reuse=True)
+        batches = []
+        for k in range(K):
+            batch = SamplesFromReplayPriExt(**_batch_fields(fields, k), is_weights=is_weights[k])
+            batches.append(self.sanitize_batch(batch, T_idxs[k], B_idxs[k])
+                           if self.batch_T > 1 else batch)
+        return batches
+
+    def update_batch_priorities(self, priorities):
+        if self.pending_tree_idxs:  # Of the next batch from sample_batches().
+            self.priority_tree.prev_tree_idxs = self.pending_tree_idxs.popleft()
+        super().update_batch_priorities(priorities)
+
+
+def get_frame_codec(codec):
+    """(compress, decompress) functions for a lossless codec name."""
+    if codec == "lz4":
+        import lz4.block  # Optional dependency, only needed for this codec.
+        return lz4.block.compress, lz4.block.decompress
+    if codec == "zlib":
+        return (lambda data: zlib.compress(data, 1)), zlib.decompress
+    raise ValueError(f"Unknown frame codec {codec}.")
+
+
+class CompressedFrames:
+    """
+    Array-like [R,B,*frame_shape] store of frames, compressed in chunks of
+    ``chunk_size`` consecutive rows per env.  Supports the indexing used by
+    rlpyt's frame buffers: ``frames[rows]`` and ``frames[rows, b]`` with an
+    int, slice or index array for ``rows``, for both reads and writes.
+
+    Written chunks are kept uncompressed until their last row is written
+    (frames arrive in time order), then compressed.  Reads decompress only
+    the chunks they touch, with a small LRU cache of decompressed chunks
+    since consecutive samples and frame offsets hit the same chunks.
+    """
+
+    def __init__(self, R, B, frame_shape, dtype, codec="lz4", chunk_size=16,
+                 cache_chunks=64):
+        self.shape = (R, B) + tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.compress, self.decompress = get_frame_codec(codec)
+        self.n_chunks = -(-R // chunk_size)
+        self.chunks = [[None] * self.n_chunks for _ in range(B)]  # bytes, None is zeros.
+        self.open_chunks = dict()  # (b, c) -> uncompressed chunk being written.
+        self.cache = OrderedDict()
+        self.cache_chunks = cache_chunks
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        """Memory used, i.e. compressed plus open chunks."""
+        return (sum(len(chunk) for chunks in self.chunks for chunk in chunks if chunk is not None)
+                + sum(chunk.nbytes for chunk in self.open_chunks.values()))
+
+    @property
+    def raw_nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __getitem__(self, key):
+        rows, bs, squeeze = self._index(key)
+        out = np.empty((len(rows), len(bs)) + self.shape[2:], dtype=self.dtype)
+        chunk_idxs = rows // self.chunk_size
+        for c in np.unique(chunk_idxs):
+            in_chunk = chunk_idxs == c
+            offsets = rows[in_chunk] - c * self.chunk_size
+            for j, b in enumerate(bs):
+                out[in_chunk, j] = self._read_chunk(b, c)[offsets]
+        return out[squeeze]
+
+    def __setitem__(self, key, value):
+        rows, bs, squeeze = self._index(key)
+        value = np.broadcast_to(value, np.empty((len(rows), len(bs)), dtype=bool)[squeeze].shape
+                                + self.shape[2:])
+        value = value.reshape((len(rows), len(bs)) + self.shape[2:])
+        chunk_idxs = rows // self.chunk_size
+        for c in np.unique(chunk_idxs):
+            in_chunk = chunk_idxs == c
+            offsets = rows[in_chunk] - c * self.chunk_size
+            last = min(self.chunk_size, self.shape[0] - c * self.chunk_size) - 1
+            for j, b in enumerate(bs):
+                chunk = self._open_chunk(b, c)
+                chunk[offsets] = value[in_chunk, j]
+                if last in offsets:  # Chunk complete (rows are written in order).
+                    self._close_chunk(b, c)
+
+    def _index(self, key):
+        """Row and env index arrays, and the index which drops int dims."""
+        rows, bs = key if isinstance(key, tuple) else (key, slice(None))
+        squeeze = tuple(0 if np.ndim(k) == 0 and not isinstance(k, slice) else slice(None)
+                        for k in (rows, bs))
+        rows = np.arange(self.shape[0])[rows].reshape(-1)
+        bs = np.arange(self.shape[1])[bs].reshape(-1)
+        return rows, bs, squeeze
+
+    def _chunk_rows(self, c):
+        return min(self.chunk_size, self.shape[0] - c * self.chunk_size)
+
+    def _read_chunk(self, b, c):
+        if (b, c) in self.open_chunks:
+            return self.open_chunks[(b, c)]
+        if (b, c) in self.cache:
+            self.cache.move_to_end((b, c))
+            return self.cache[(b, c)]
+        shape = (self._chunk_rows(c),) + self.shape[2:]
+        data = self.chunks[b][c]
+        chunk = np.zeros(shape, dtype=self.dtype) if data is None else \
+            np.frombuffer(self.decompress(data), dtype=self.dtype).reshape(shape)
+        self.cache[(b, c)] = chunk
+        if len(self.cache) > self.cache_chunks:
+            self.cache.popitem(last=False)
+        return chunk
+
+    def _open_chunk(self, b, c):
+        if (b, c) not in self.open_chunks:
+            # Keep the rows of the old chunk which are not overwritten yet.
+            self.open_chunks[(b, c)] = self._read_chunk(b, c).copy()
+            self.cache.pop((b, c), None)
+        return self.open_chunks[(b, c)]
+
+    def _close_chunk(self, b, c):
+        self.chunks[b][c] = self.compress(self.open_chunks.pop((b, c)).tobytes())
+
+
+class _RowOffset:
+    """Rows of ``frames`` shifted by ``offset``, for ``samples_new_frames``."""
+
+    def __init__(self, frames, offset):
+        self.frames = frames
+        self.offset = offset
+
+    def __getitem__(self, key):
+        rows, bs = key if isinstance(key, tuple) else (key, slice(None))
+        return self.frames[self._shift(rows), bs]
+
+    def __setitem__(self, key, value):
+        rows, bs = key if isinstance(key, tuple) else (key, slice(None))
+        self.frames[self._shift(rows), bs] = value
+
+    def _shift(self, rows):
+        return np.arange(self.offset, len(self.frames))[rows]
+
+
+def _frame_placeholder(example):
+    """``example`` with 1-pixel frames, so the frame buffer allocates ~nothing."""
+    observation = np.asarray(example.observation)
+    placeholder = np.zeros(observation.shape[:1] + (1,) * (observation.ndim - 1),
+                           dtype=observation.dtype)
+    return example._replace(observation=placeholder)
+
+
+class CompressedFrameBufferMixin:
+    """
+    Replaces the raw ``samples_frames`` of rlpyt's frame buffers by
+    ``CompressedFrames``, so that ``extract_batch()``, ``sample_batch()``
+    and ``append_samples()`` of the buffer work unchanged.  The frame buffer
+    is built from a placeholder observation with 1-pixel frames (so the raw
+    frames are never allocated), and then its frame arrays are swapped.
+    NOTE: The frames live in this process only; not for use with an async
+    sampler writing to the buffer from other processes.
+    """
+
+    def __init__(self, example, frame_codec="lz4", frame_chunk_size=16, **kwargs):
+        observation = np.asarray(example.observation)
+        super().__init__(example=_frame_placeholder(example), **kwargs)
+        fm1 = self.n_frames - 1
+        self.samples_frames = CompressedFrames(self.T + fm1, self.B, observation.shape[1:],
+            observation.dtype, codec=frame_codec, chunk_size=frame_chunk_size)
+        self.samples_new_frames = _RowOffset(self.samples_frames, fm1)
+
+    def frames_memory_info(self):
+        """Compressed and raw sizes of the frames, in bytes."""
+        return self.samples_frames.nbytes, self.samples_frames.raw_nbytes
+
+
+class CompressedUniformSequenceReplayFrameBufferExtended(CompressedFrameBufferMixin,
+        AsyncUniformSequenceReplayFrameBufferExtended):
+    pass
+
+
+class CompressedPrioritizedSequenceReplayFrameBufferExtended(CompressedFrameBufferMixin,
+        AsyncPrioritizedSequenceReplayFrameBufferExtended):
+    pass
+
+def _open_memmaps(buf, path, mode):
+    """Memmaps, one .npy file per field, with the structure, shapes and dtypes
+    of ``buf``; created zeroed in mode 'w+', reopened as they are in 'r+'."""
+    if hasattr(buf, "_fields"):
+        return type(buf)(*(_open_memmaps(getattr(buf, field), path + "." + field, mode)
+                           for field in buf._fields))
+    if mode == "r+":
+        array = np.lib.format.open_memmap(path + ".npy", mode="r+")
+        if array.shape != buf.shape or array.dtype != buf.dtype:
+            raise ValueError(f"{path}.npy has shape {array.shape} and dtype {array.dtype}, "
+                             f"expected {buf.shape} and {buf.dtype}.")
+        return array
+    return np.lib.format.open_memmap(path + ".npy", mode="w+", dtype=buf.dtype, shape=buf.shape)
+
+
+def _flush_memmaps(buf):
+    if hasattr(buf, "_fields"):
+        for field in buf._fields:
+            _flush_memmaps(getattr(buf, field))
+    else:
+        buf.flush()
+
+
+class MemmapFrameBufferMixin:
+    """
+    Keeps the replay samples (frames, action, reward, done, value and the
+    n-step returns) in ``np.memmap`` files under ``replay_dir``, leaving
+    their residency to the OS page cache.  ``flush()`` writes them out with
+    the write position and the priority tree; with ``reopen=True`` a buffer
+    of the same size resumes from the last flush in ``replay_dir``.
+    The frame buffer is built from 1-pixel frames, so that the full frames
+    are only ever allocated on disk.
+    """
+
+    def __init__(self, example, replay_dir, reopen=False, **kwargs):
+        observation = np.asarray(example.observation)
+        super().__init__(example=_frame_placeholder(example), **kwargs)
+        os.makedirs(replay_dir, exist_ok=True)
+        self.replay_dir = replay_dir
+        self.metadata_path = os.path.join(replay_dir, "replay.json")
+        reopen = reopen and os.path.exists(self.metadata_path)
+        mode = "r+" if reopen else "w+"
+
+        def path(name):
+            return os.path.join(replay_dir, name)
+        # The new buffers are all zeros, like the files created for them.
+        frames = np.broadcast_to(np.zeros((), dtype=observation.dtype),
+                                 (self.T + self.n_frames - 1, self.B) + observation.shape[1:])
+        self.samples_frames = _open_memmaps(frames, path("frames"), mode)
+        self.samples_new_frames = self.samples_frames[self.n_frames - 1:]
+        self.samples = _open_memmaps(self.samples, path("samples"), mode)
+        if self.n_step_return > 1:
+            self.samples_return_ = _open_memmaps(self.samples_return_, path("return_"), mode)
+            self.samples_done_n = _open_memmaps(self.samples_done_n, path("done_n"), mode)
+        else:
+            self.samples_return_ = self.samples.reward
+            self.samples_done_n = self.samples.done
+        if reopen:
+            self._load_metadata()
+
+    def flush(self):
+        """Writes the samples to disk, then the metadata to resume from."""
+        for buf in (self.samples_frames, self.samples, self.samples_return_, self.samples_done_n):
+            _flush_memmaps(buf)
+        metadata = dict(T=self.T, B=self.B, t=int(self.t), buffer_full=bool(self._buffer_full))
+        priority_tree = getattr(self, "priority_tree", None)
+        if priority_tree is not None:
+            arrays, scalars = dict(), dict()
+            for k, v in vars(priority_tree).items():
+                if isinstance(v, np.ndarray):
+                    arrays[k] = v
+                elif isinstance(v, (bool, int, float, np.bool_, np.integer, np.floating)):
+                    scalars[k] = v.item() if isinstance(v, np.generic) else v
+            scalars["t"] = int(priority_tree.t)  # A property of the async tree.
+            np.savez(os.path.join(self.replay_dir, "priority_tree.npz"), **arrays)
+            metadata["priority_tree"] = scalars
+        tmp_path = self.metadata_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(metadata, f)
+        os.replace(tmp_path, self.metadata_path)  # Atomic, a crash keeps the old one.
+
+    def _load_metadata(self):
+        with open(self.metadata_path) as f:
+            metadata = json.load(f)
+        if (metadata["T"], metadata["B"]) != (self.T, self.B):
+            raise ValueError(f"Replay in {self.replay_dir} has T={metadata['T']}, "
+                             f"B={metadata['B']}, expected T={self.T}, B={self.B}.")
+        self.t, self._buffer_full = metadata["t"], metadata["buffer_full"]
+        if hasattr(self, "_async_push"):
+            self._async_push()  # Shared write position of the async buffers.
+        self.reset_done_offsets()
+        if "priority_tree" in metadata:
+            for k, v in metadata["priority_tree"].items():
+                setattr(self.priority_tree, k, v)
+            with np.load(os.path.join(self.replay_dir, "priority_tree.npz")) as arrays:
+                for k in arrays.files:
+                    array = getattr(self.priority_tree, k, None)
+                    if isinstance(array, np.ndarray) and array.shape == arrays[k].shape:
+                        array[...] = arrays[k]  # In place, the tree may be shared.
+                    else:
+                        setattr(self.priority_tree, k, arrays[k])
+
+
+class MemmapUniformSequenceReplayFrameBufferExtended(MemmapFrameBufferMixin,
+        AsyncUniformSequenceReplayFrameBufferExtended):
+    pass
+
+
+class MemmapPrioritizedSequenceReplayFrameBufferExtended(MemmapFrameBufferMixin,
+        AsyncPrioritizedSequenceReplayFrameBufferExtended):
+    pass
+
+class ReplayPrefetcher:
+    """
+    Wraps an extended replay buffer so that a background thread samples the
+    next ``n_prefetch`` batches while the learner trains on the current one.
+    Each batch is copied into one of ``n_prefetch + 1`` reusable (pinned, for
+    fast transfer to the GPU) slots; a slot is handed back to the thread when
+    the learner asks for the following batch.
+
+    With a prioritized buffer, ``update_batch_priorities()`` must be called
+    once per batch, in order; each call is applied to the tree indices of
+    the batch it belongs to.  The thread only draws a new batch while fewer
+    than ``n_prefetch + 1`` batches are waiting for their priority update, so
+    every batch is drawn from priorities lacking at most the updates of the
+    ``n_prefetch`` batches before it.  Other attributes are forwarded to the
+    wrapped buffer.
+    """
+
+    def __init__(self, replay_buffer, batch_B, n_prefetch=2, pin_memory=True):
+        self.replay_buffer = replay_buffer
+        self.batch_B = batch_B
+        self.prioritized = hasattr(replay_buffer, "priority_tree")
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.max_outstanding = n_prefetch + 1
+        self.lock = threading.Lock()  # Guards the buffer and its sum tree.
+        self.outstanding = threading.Condition()
+        self.n_outstanding = 0
+        self.pending_tree_idxs = deque()
+        self.slots = [None] * (n_prefetch + 1)
+        self.free_slots = queue.Queue()
+        for i in range(n_prefetch + 1):
+            self.free_slots.put(i)
+        self.ready = queue.Queue()
+        self.current_slot = None
+        self.thread = None
+
+    def __getattr__(self, name):
+        if name == "replay_buffer":
+            raise AttributeError(name)
+        return getattr(self.replay_buffer, name)
+
+    def append_samples(self, samples):
+        with self.lock:
+            return self.replay_buffer.append_samples(samples)
+
+    def sample_batch(self, batch_B):
+        assert batch_B == self.batch_B
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._prefetch, daemon=True)
+            self.thread.start()
+        if self.current_slot is not None:
+            self.free_slots.put(self.current_slot)
+        self.current_slot, batch, tree_idxs = self.ready.get()
+        if isinstance(batch, Exception):
+            raise batch
+        if self.prioritized:
+            self.pending_tree_idxs.append(tree_idxs)
         return batch
+
+    def update_batch_priorities(self, priorities):
+        with self.lock:
+            self.replay_buffer.priority_tree.prev_tree_idxs = self.pending_tree_idxs.popleft()
+            self.replay_buffer.update_batch_priorities(priorities)
+        with self.outstanding:
+            self.n_outstanding -= 1
+            self.outstanding.notify()
+
+    def _prefetch(self):
+        try:
+            while True:
+                slot = self.free_slots.get()
+                if self.prioritized:
+                    with self.outstanding:
+                        self.outstanding.wait_for(lambda: self.n_outstanding < self.max_outstanding)
+                        self.n_outstanding += 1
+                with self.lock:
+                    batch = self.replay_buffer.sample_batch(self.batch_B)
+                    tree_idxs = self.replay_buffer.priority_tree.prev_tree_idxs.copy() \
+                        if self.prioritized else None
+                if self.slots[slot] is None:
+                    self.slots[slot] = self._allocate(batch)
+                self.ready.put((slot, self._copy(batch, self.slots[slot]), tree_idxs))
+        except Exception as e:
+            traceback.print_exc()
+            self.ready.put((None, e, None))
+
+    def _allocate(self, batch):
+        if torch.is_tensor(batch):
+            return batch.pin_memory() if self.pin_memory else batch.clone()
+        if isinstance(batch, tuple):
+            return _like(batch, (self._allocate(b) for b in batch))
+        return None  # Not a tensor: passed through as is.
+
+    def _copy(self, batch, slot):
+        if torch.is_tensor(batch):
+            return slot.copy_(batch)
+        if isinstance(batch, tuple):
+            return _like(batch, (self._copy(b, s) for b, s in zip(batch, slot)))
+        return batch
+
+
+def _like(tup, items):
+    """A tuple (or namedtuple) of the same type as ``tup``."""
+    return type(tup)(*items) if hasattr(tup, "_fields") else tuple(items)
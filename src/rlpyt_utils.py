@@ -3,6 +3,7 @@ from rlpyt.samplers.buffer import build_samples_buffer
 from rlpyt.samplers.parallel.cpu.collectors import CpuResetCollector
 from rlpyt.samplers.serial.collectors import SerialEvalCollector
 from rlpyt.utils.buffer import buffer_from_example, torchify_buffer, numpify_buffer
+from rlpyt.utils.collections import AttrDict, namedarraytuple
 from rlpyt.utils.logging import logger
 from rlpyt.utils.quick_args import save__init__args
 from rlpyt.utils.seed import set_seed
@@ -11,9 +12,16 @@ from rlpyt.runners.minibatch_rl import MinibatchRlEval
 import wandb
 import psutil
 
+from src.utils import CsvWriter, PhaseTimer
+
 import torch
 import numpy as np
 import time
+import ctypes
+import threading
+import traceback
+import multiprocessing as mp
+from statistics import NormalDist
 
 
 atari_human_scores = dict(
@@ -70,19 +78,41 @@ def maybe_update_summary(key, value):
 
 class MinibatchRlEvalWandb(MinibatchRlEval):
 
-    def __init__(self, final_eval_only=False, *args, **kwargs):
+    def __init__(self, final_eval_only=False, async_eval=False, timing=False,
+                 timing_cuda_sync=False, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.final_eval_only = final_eval_only
+        # Per-phase timers for the training loop and (shared with the algo)
+        # the sub-phases of optimize_agent.
+        self.timer = PhaseTimer(enabled=timing, cuda_sync=timing_cuda_sync)
+        # Evaluate weight snapshots in the background eval workers while
+        # training continues (needs a ParallelEvalCollector).
+        self.async_eval = async_eval
 
         # the index for saving scores
         self.index = 0
-        self.score = None
-
-    def log_diagnostics(self, itr, eval_traj_infos, eval_time):
-        cum_steps = (itr + 1) * self.sampler.batch_size * self.world_size
-        self.wandb_info = {'cum_steps': cum_steps}
+        self.score_writer = None
+        # Under async_eval, the iteration of the weights being logged.
+        self._score_itr = None
+
+    def log_diagnostics(self, itr, eval_traj_infos, eval_time, eval_itr=None):
+        """With ``eval_itr``, the evaluation results came from the weights of
+        that earlier iteration and are logged to wandb against its steps."""
+        eval_itr = itr if eval_itr is None else eval_itr
+        self.wandb_info = {'cum_steps': self.get_cum_steps(itr)}
+        self.eval_wandb_info = {'cum_steps': self.get_cum_steps(eval_itr)}
+        self._score_itr = eval_itr if self.async_eval else None
         super().log_diagnostics(itr, eval_traj_infos, eval_time)
-        wandb.log(self.wandb_info)
+        if eval_itr == itr:
+            self.wandb_info.update(self.eval_wandb_info)
+            wandb.log(self.wandb_info)
+        else:
+            wandb.log(self.wandb_info)
+            if eval_traj_infos:
+                wandb.log(self.eval_wandb_info)
+
+    def get_cum_steps(self, itr):
+        return (itr + 1) * self.sampler.batch_size * self.world_size
 
     def startup(self):
         """
@@ -134,6 +164,11 @@ class MinibatchRlEvalWandb(MinibatchRlEval):
             rank=rank,
         )
         self.initialize_logging()
+        self.algo.timer = self.timer
+        if self.async_eval:
+            assert hasattr(self.sampler.eval_collector, "submit"), \
+                "Asynchronous evaluation needs a ParallelEvalCollector."
+            self._async_eval_itr = self._async_eval_start = None
         return n_itr
 
     def _log_infos(self, traj_infos=None):
@@ -146,65 +181,9 @@ class MinibatchRlEvalWandb(MinibatchRlEval):
         if traj_infos:
             for k in traj_infos[0]:
                 if not k.startswith("_"):
-                    values = [info[k] for info in traj_infos]
                     logger.record_tabular_misc_stat(k,
-                                                    values)
-
-                    wandb.run.summary[k] = np.average(values)
-                    self.wandb_info[k + "Average"] = np.average(values)
-                    self.wandb_info[k + "Std"] = np.std(values)
-                    self.wandb_info[k + "Min"] = np.min(values)
-                    self.wandb_info[k + "Max"] = np.max(values)
-                    self.wandb_info[k + "Median"] = np.median(values)
-                    if k == 'GameScore':
-                        game = self.sampler.env_kwargs['game']
-                        if game in {'adventure'}:
-                            score = np.average(values)
-                            maybe_update_summary(k + "Best", np.average(values))
-
-                            # save normalized score
-                            if self.index == 0:
-                                self.score = np.array([self.index * self.log_interval_steps,
-                                                       np.average(values)]).reshape(1, 2)
-                            else:
-                                new_score = np.array([self.index * self.log_interval_steps,
-                                                      np.average(values)]).reshape(1, 2)
-                                self.score = np.vstack((self.score, new_score))
-                            self.index += 1
-                            header = "iter, score"
-                            np.savetxt(wandb.run.dir + "/score.csv", self.score, delimiter=",", header=header)
-                        else:
-                            random_score = atari_random_scores[game]
-                            der_score = atari_der_scores[game]
-                            nature_score = atari_nature_scores[game]
-                            human_score = atari_human_scores[game]
-                            normalized_score = (np.average(values) - random_score) / (human_score - random_score)
-                            der_normalized_score = (np.average(values) - random_score) / (der_score - random_score)
-                            nature_normalized_score = (np.average(values) - random_score) / (nature_score - random_score)
-                            self.wandb_info[k + "Normalized"] = normalized_score
-                            self.wandb_info[k + "DERNormalized"] = der_normalized_score
-                            self.wandb_info[k + "NatureNormalized"] = nature_normalized_score
-
-                            maybe_update_summary(k+"Best", np.average(values))
-                            maybe_update_summary(k+"NormalizedBest", normalized_score)
-                            maybe_update_summary(k+"DERNormalizedBest", der_normalized_score)
-                            maybe_update_summary(k+"NatureNormalizedBest", nature_normalized_score)
-
-                            # save normalized score
-                            if self.index == 0:
-                                self.score = np.array([self.index*self.log_interval_steps,  normalized_score,
-                                                       der_normalized_score, nature_normalized_score,
-                                                       np.average(values)]).reshape(1, 5)
-                            else:
-                                new_score = np.array([self.index*self.log_interval_steps, normalized_score,
-                                                      der_normalized_score, nature_normalized_score,
-                                                      np.average(values)]).reshape(1, 5)
-                                self.score = np.vstack((self.score, new_score))
-                            self.index += 1
-                            header = "iter, human_normalized_score, der_normalized_score, nature_normalized_score," \
-                                     " score"
-                            # print(wandb.run.dir)
-                            np.savetxt(wandb.run.dir+"/score.csv", self.score, delimiter=",", header=header)
+                                                    [info[k] for info in traj_infos])
+            self._log_traj_infos(traj_infos, self._score_itr)
 
         if self._opt_infos:
             for k, v in self._opt_infos.items():
@@ -212,6 +191,80 @@ class MinibatchRlEvalWandb(MinibatchRlEval):
                 self.wandb_info[k] = np.average(v)
                 wandb.run.summary[k] = np.average(v)
         self._opt_infos = {k: list() for k in self._opt_infos}  # (reset)
+        for k, v in self.timer.stats().items():
+            logger.record_tabular("Time" + k, v)
+            self.wandb_info["Time/" + k] = v
+        replay_buffer = getattr(self.algo, "replay_buffer", None)
+        if hasattr(replay_buffer, "frames_memory_info"):
+            frames_bytes, raw_frames_bytes = replay_buffer.frames_memory_info()
+            logger.record_tabular("ReplayFramesMB", frames_bytes / 1e6)
+            logger.record_tabular("ReplayFramesRawMB", raw_frames_bytes / 1e6)
+            self.wandb_info["Replay/FramesMB"] = frames_bytes / 1e6
+            self.wandb_info["Replay/FramesRawMB"] = raw_frames_bytes / 1e6
+        if hasattr(replay_buffer, "replay_dir"):
+            replay_buffer.flush()  # Checkpoint the memmapped replay.
+
+    def _log_traj_infos(self, traj_infos, eval_itr=None):
+        """
+        Writes trajectory info into the wandb summary, ``self.eval_wandb_info``
+        and the score csv.  The csv ``iter`` is the number of evaluations
+        times the log interval, or with ``eval_itr`` (asynchronous evaluation,
+        where evaluations are skipped and arrive late) the steps of the
+        weights evaluated, 0 for the initial ones.
+        """
+        if eval_itr is None:
+            score_step = self.index * self.log_interval_steps
+        else:
+            score_step = 0 if eval_itr == 0 else self.get_cum_steps(eval_itr)
+        self.eval_wandb_info['TrajsInEval'] = len(traj_infos)
+        for k in traj_infos[0]:
+            if not k.startswith("_"):
+                values = [info[k] for info in traj_infos]
+                wandb.run.summary[k] = np.average(values)
+                self.eval_wandb_info[k + "Average"] = np.average(values)
+                self.eval_wandb_info[k + "Std"] = np.std(values)
+                self.eval_wandb_info[k + "Min"] = np.min(values)
+                self.eval_wandb_info[k + "Max"] = np.max(values)
+                self.eval_wandb_info[k + "Median"] = np.median(values)
+                if k == 'GameScore':
+                    game = self.sampler.env_kwargs['game']
+                    if game in {'adventure'}:
+                        score = np.average(values)
+                        maybe_update_summary(k + "Best", np.average(values))
+
+                        # save normalized score
+                        if self.index == 0:
+                            header = "iter, score"
+                            self.score_writer = CsvWriter(wandb.run.dir + "/score.csv", header, flush_interval=0.)
+                        self.score_writer.write([score_step, np.average(values)])
+                        self.index += 1
+                    else:
+                        random_score = atari_random_scores[game]
+                        der_score = atari_der_scores[game]
+                        nature_score = atari_nature_scores[game]
+                        human_score = atari_human_scores[game]
+                        normalized_score = (np.average(values) - random_score) / (human_score - random_score)
+                        der_normalized_score = (np.average(values) - random_score) / (der_score - random_score)
+                        nature_normalized_score = (np.average(values) - random_score) / (nature_score - random_score)
+                        self.eval_wandb_info[k + "Normalized"] = normalized_score
+                        self.eval_wandb_info[k + "DERNormalized"] = der_normalized_score
+                        self.eval_wandb_info[k + "NatureNormalized"] = nature_normalized_score
+
+                        maybe_update_summary(k+"Best", np.average(values))
+                        maybe_update_summary(k+"NormalizedBest", normalized_score)
+                        maybe_update_summary(k+"DERNormalizedBest", der_normalized_score)
+                        maybe_update_summary(k+"NatureNormalizedBest", nature_normalized_score)
+
+                        # save normalized score
+                        if self.index == 0:
+                            header = "iter, human_normalized_score, der_normalized_score, nature_normalized_score," \
+                                     " score"
+                            # print(wandb.run.dir)
+                            self.score_writer = CsvWriter(wandb.run.dir + "/score.csv", header, flush_interval=0.)
+                        self.score_writer.write([score_step, normalized_score,
+                                                 der_normalized_score, nature_normalized_score,
+                                                 np.average(values)])
+                        self.index += 1
 
     def evaluate_agent(self, itr):
         """
@@ -236,6 +289,46 @@ class MinibatchRlEvalWandb(MinibatchRlEval):
         logger.log("Evaluation runs complete.")
         return traj_infos, eval_time
 
+    def evaluate_agent_async(self, itr):
+        """
+        Collects the results of the background evaluation if it finished, and
+        submits a snapshot of the current weights if the eval workers are idle.
+        Returns the trajectory infos (empty if none arrived) and the iteration
+        whose weights they were collected with.
+        """
+        if itr > 0:
+            self.pbar.stop()
+        collector = self.sampler.eval_collector
+        traj_infos, eval_itr = [], itr
+        if collector.busy:
+            traj_infos = collector.poll()
+            if traj_infos is None:
+                logger.log(f"Evaluation of itr #{self._async_eval_itr} still running, "
+                           f"skipping evaluation.")
+                return [], itr
+            eval_itr = self._async_eval_itr
+            logger.log(f"Evaluation of itr #{eval_itr} complete "
+                       f"({time.time() - self._async_eval_start:.1f}s).")
+
+        if self.final_eval_only:
+            eval = itr == 0 or itr >= self.n_itr - 1
+        else:
+            eval = itr == 0 or itr >= self.min_itr_learn - 1
+        if eval:
+            logger.log("Submitting agent for evaluation...")
+            collector.submit(itr)
+            self._async_eval_itr, self._async_eval_start = itr, time.time()
+        return traj_infos, eval_itr
+
+    def finish_async_eval(self):
+        """Waits for a running background evaluation and logs its results to
+        wandb against the steps of its weight snapshot."""
+        collector = self.sampler.eval_collector
+        if collector.busy:
+            self.eval_wandb_info = {'cum_steps': self.get_cum_steps(self._async_eval_itr)}
+            self._log_traj_infos(collector.poll(block=True), self._async_eval_itr)
+            wandb.log(self.eval_wandb_info)
+
     def train(self):
         """
         Performs startup, evaluates the initial agent, then loops by
@@ -246,19 +339,36 @@ class MinibatchRlEvalWandb(MinibatchRlEval):
         n_itr = self.startup()
         self.n_itr = n_itr
         with logger.prefix(f"itr #0 "):
-            eval_traj_infos, eval_time = self.evaluate_agent(0)
-            self.log_diagnostics(0, eval_traj_infos, eval_time)
+            if self.async_eval:
+                eval_traj_infos, eval_itr = self.evaluate_agent_async(0)
+                self.log_diagnostics(0, eval_traj_infos, 0.0, eval_itr)
+            else:
+                eval_traj_infos, eval_time = self.evaluate_agent(0)
+                self.log_diagnostics(0, eval_traj_infos, eval_time)
         for itr in range(n_itr):
             logger.set_iteration(itr)
             with logger.prefix(f"itr #{itr} "):
                 self.agent.sample_mode(itr)
-                samples, traj_infos = self.sampler.obtain_samples(itr)
+                with self.timer.phase("Sample"):
+                    samples, traj_infos = self.sampler.obtain_samples(itr)
                 self.agent.train_mode(itr)
-                opt_info = self.algo.optimize_agent(itr, samples)
+                with self.timer.phase("Optimize"):
+                    opt_info = self.algo.optimize_agent(itr, samples)
                 self.store_diagnostics(itr, traj_infos, opt_info)
                 if (itr + 1) % self.log_interval_itrs == 0:
-                    eval_traj_infos, eval_time = self.evaluate_agent(itr)
-                    self.log_diagnostics(itr, eval_traj_infos, eval_time)
+                    if self.async_eval and itr < n_itr - 1:
+                        # Eval time is not charged to training, it runs alongside.
+                        with self.timer.phase("Eval"):
+                            eval_traj_infos, eval_itr = self.evaluate_agent_async(itr)
+                        self.log_diagnostics(itr, eval_traj_infos, 0.0, eval_itr)
+                    else:
+                        with self.timer.phase("Eval"):
+                            if self.async_eval:  # The final evaluation is synchronous.
+                                self.finish_async_eval()
+                            eval_traj_infos, eval_time = self.evaluate_agent(itr)
+                        self.log_diagnostics(itr, eval_traj_infos, eval_time)
+        if self.async_eval:
+            self.finish_async_eval()
         self.shutdown()
 
 
@@ -273,61 +383,207 @@ def delete_ind_from_array(array, ind):
 
 
 class OneToOneSerialEvalCollector(SerialEvalCollector):
+    """Runs exactly one evaluation trajectory in each env.
+
+    With ``ci_width``, evaluation stops early once the confidence interval of
+    the mean ``ci_metric`` (``GameScore`` or ``GameScoreNormalized``) is at
+    most that wide, after at least ``min_trajectories`` episodes.  All envs
+    still run together (so inference stays batched), and the interval is
+    computed over the longest prefix of envs which have all finished, so that
+    short episodes are not favoured.  Games without reference scores fall
+    back to ``GameScore``.
+    """
+
+    def __init__(self, *args, ci_width=None, ci_metric="GameScore",
+                 ci_confidence=0.95, min_trajectories=10, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ci_width = ci_width
+        self.min_trajectories = max(min_trajectories, 2)
+        self.ci_z = NormalDist().inv_cdf(0.5 + ci_confidence / 2)
+        assert ci_metric in ("GameScore", "GameScoreNormalized"), f"Unknown ci_metric {ci_metric}."
+        game = self.envs[0].game
+        self.ci_scale = 1.
+        if ci_metric == "GameScoreNormalized":
+            if game in atari_human_scores and game in atari_random_scores:
+                self.ci_scale = 1. / (atari_human_scores[game] - atari_random_scores[game])
+            else:
+                logger.log(f"No reference scores for {game}: eval confidence "
+                           "interval on GameScore.")
+
+    def ci_reached(self, traj_infos):
+        """Whether the confidence interval of the mean score over
+        ``traj_infos`` is narrower than ``ci_width``."""
+        if len(traj_infos) < self.min_trajectories:
+            return False
+        scores = self.ci_scale * np.array([info.GameScore for info in traj_infos])
+        width = 2 * self.ci_z * np.std(scores, ddof=1) / np.sqrt(len(scores))
+        return width <= self.ci_width
+
     def collect_evaluation(self, itr):
-        assert self.max_trajectories == len(self.envs)
-        traj_infos = [self.TrajInfoCls() for _ in range(len(self.envs))]
-        completed_traj_infos = list()
-        observations = list()
-        for env in self.envs:
-            observations.append(env.reset())
-        observation = buffer_from_example(observations[0], len(self.envs))
+        n_envs = len(self.envs)
+        assert self.max_trajectories == n_envs
+        adaptive = self.ci_width is not None
+        traj_infos = [self.TrajInfoCls() for _ in range(n_envs)]
+        completed_traj_infos = [None] * n_envs  # By env, so prefixes are known.
+        n_completed = n_prefix = 0
+        # Row b of the batch holds env live_envs[b].  Two fixed-size copies are
+        # preallocated (and torchified) once; when envs finish, the rows of
+        # the remaining ones are gathered into the other copy.
+        observations = [env.reset() for env in self.envs]
+        example = StepBuffer(observations[0], self.envs[0].action_space.null_value(),
+                             np.zeros((), dtype="float32"))
+        buffers = [buffer_from_example(example, n_envs) for _ in range(2)]
+        buffers_pyt = [torchify_buffer(buf) for buf in buffers]
+        cur = 0
+        buf, buf_pyt = buffers[cur], buffers_pyt[cur]
         for b, o in enumerate(observations):
-            observation[b] = o
-        action = buffer_from_example(self.envs[0].action_space.null_value(),
-                                     len(self.envs))
-        reward = np.zeros(len(self.envs), dtype="float32")
-        obs_pyt, act_pyt, rew_pyt = torchify_buffer((observation, action, reward))
+            buf.observation[b] = o
+        live = np.ones(n_envs, dtype=bool)
+        live_envs = np.arange(n_envs)
         self.agent.reset()
         self.agent.eval_mode(itr)
-        live_envs = list(range(len(self.envs)))
+        # Every trajectory starts at t=0, so t is also the length of each
+        # live one: max_T caps each trajectory.
         for t in range(self.max_T):
-            act_pyt, agent_info = self.agent.step(obs_pyt, act_pyt, rew_pyt)
+            n_live = len(live_envs)
+            step_pyt = buf_pyt[:n_live]
+            act_pyt, agent_info = self.agent.step(*step_pyt)
             action = numpify_buffer(act_pyt)
 
-            b = 0
-            while b < len(live_envs):  # don't want to do a for loop since live envs changes over time
-                env_id = live_envs[b]
-                o, r, d, env_info = self.envs[env_id].step(action[b])
-                traj_infos[env_id].step(observation[b],
+            env_steps = (self.envs[env_id].step(a) for env_id, a in zip(live_envs, action))
+            for b, (env_id, (o, r, d, env_info)) in enumerate(zip(live_envs, env_steps)):
+                traj_infos[env_id].step(buf.observation[b],
                                         action[b], r, d,
                                         agent_info[b], env_info)
                 if getattr(env_info, "traj_done", d):
-                    completed_traj_infos.append(traj_infos[env_id].terminate(o))
-
-                    observation = delete_ind_from_array(observation, b)
-                    reward = delete_ind_from_array(reward, b)
-                    action = delete_ind_from_array(action, b)
-                    obs_pyt, act_pyt, rew_pyt = torchify_buffer((observation, action, reward))
-
-                    del live_envs[b]
-                    b -= 1  # live_envs[b] is now the next env, so go back one.
+                    completed_traj_infos[env_id] = traj_infos[env_id].terminate(o)
+                    n_completed += 1
+                    live[env_id] = False
                 else:
-                    observation[b] = o
-                    reward[b] = r
-
-                b += 1
+                    buf.observation[b] = o
+                    buf.reward[b] = r
+            buf.action[:n_live] = action
+
+            if (self.max_trajectories is not None and
+                    n_completed >= self.max_trajectories):
+                logger.log("Evaluation reached max num trajectories "
+                           f"({self.max_trajectories}).")
+                return completed_traj_infos
+            keep = np.flatnonzero(live[live_envs])
+            if len(keep) < n_live:
+                cur = 1 - cur
+                for src, dst in zip(buf, buffers[cur]):
+                    np.take(src[:n_live], keep, axis=0, out=dst[:len(keep)])
+                buf, buf_pyt = buffers[cur], buffers_pyt[cur]
+                live_envs = live_envs[keep]
+                while n_prefix < n_envs and completed_traj_infos[n_prefix] is not None:
+                    n_prefix += 1
+                if adaptive and self.ci_reached(completed_traj_infos[:n_prefix]):
+                    logger.log("Evaluation reached confidence interval width "
+                               f"({self.ci_width}) after {n_prefix} trajectories.")
+                    return completed_traj_infos[:n_prefix]
+
+        logger.log("Evaluation reached max num time steps "
+                   f"({self.max_T}).")
+        return [info for info in completed_traj_infos if info is not None]
+
+
+def parallel_eval_worker(collector, state_dict, seed, conn):
+    """Worker loop of ``ParallelEvalCollector``: for each requested
+    evaluation, loads the latest weights into its CPU agent, runs its
+    collector and sends back the completed trajectory infos."""
+    torch.set_num_threads(1)
+    set_seed(seed)
+    while True:
+        itr = conn.recv()
+        if itr is None:
+            break
+        collector.agent.model.load_state_dict(state_dict)
+        conn.send(collector.collect_evaluation(itr))
+    for env in collector.envs:
+        env.close()
+
+
+class ParallelEvalCollector:
+    """Splits the evaluation envs across ``n_workers`` forked processes, each
+    running a ``OneToOneSerialEvalCollector`` over its own slice with batched
+    inference on a CPU copy of the agent.  Before each evaluation the model
+    weights are copied into a shared-memory state dict which the workers
+    load from.  Returns the same trajectory infos as the serial collector.
+    Evaluations can also run in the background with ``submit()`` and
+    ``poll()``, while the master process keeps training.
+    NOTE: Must be created before the agent is moved to the GPU (the sampler
+    does so in ``initialize()``), so that the forked copies live on the CPU.
+    """
 
-                if (self.max_trajectories is not None and
-                        len(completed_traj_infos) >= self.max_trajectories):
-                    logger.log("Evaluation reached max num trajectories "
-                               f"({self.max_trajectories}).")
-                    return completed_traj_infos
+    def __init__(self, envs, agent, TrajInfoCls, max_T, max_trajectories=None,
+                 n_workers=1, **kwargs):
+        assert max_trajectories == len(envs)
+        assert kwargs.get("ci_width") is None, "Early stopping needs all envs in one collector."
+        self.agent = agent
+        self.envs = envs
+        self.state_dict = {k: v.detach().cpu().clone().share_memory_()
+                           for k, v in agent.model.state_dict().items()}
+        self._results = None
+        ctx = mp.get_context("fork")
+        self.workers, self.conns = list(), list()
+        for rank, env_ids in enumerate(np.array_split(np.arange(len(envs)),
+                                                      min(n_workers, len(envs)))):
+            collector = OneToOneSerialEvalCollector(
+                envs=[envs[i] for i in env_ids],
+                agent=agent,
+                TrajInfoCls=TrajInfoCls,
+                max_T=max_T,
+                max_trajectories=len(env_ids),
+                **kwargs,
+            )
+            seed = (torch.initial_seed() + rank + 1) % 2 ** 32
+            conn, worker_conn = ctx.Pipe()
+            w = ctx.Process(target=parallel_eval_worker,
+                            args=(collector, self.state_dict, seed, worker_conn),
+                            daemon=True)
+            w.start()
+            self.workers.append(w)
+            self.conns.append(conn)
 
-        if t == self.max_T - 1:
-            logger.log("Evaluation reached max num time steps "
-                       f"({self.max_T}).")
+    def collect_evaluation(self, itr):
+        self.submit(itr)
+        return self.poll(block=True)
+
+    def submit(self, itr):
+        """Snapshots the current weights and starts an evaluation in the
+        background; the results are then returned by ``poll()``."""
+        assert not self.busy, "Previous evaluation has not been polled yet."
+        for k, v in self.agent.model.state_dict().items():
+            self.state_dict[k].copy_(v)
+        for conn in self.conns:
+            conn.send(itr)
+        self._results = [None] * len(self.conns)
+
+    def poll(self, block=False):
+        """Returns the completed trajectory infos of the submitted evaluation
+        once every worker has finished it, else ``None``."""
+        for i, conn in enumerate(self.conns):
+            if self._results[i] is None and (block or conn.poll()):
+                self._results[i] = conn.recv()
+        if any(result is None for result in self._results):
+            return None
+        completed_traj_infos = [info for result in self._results for info in result]
+        self._results = None
         return completed_traj_infos
 
+    @property
+    def busy(self):
+        return self._results is not None
+
+    def shutdown(self):
+        if self.busy:
+            self.poll(block=True)
+        for conn in self.conns:
+            conn.send(None)
+        for w in self.workers:
+            w.join()
+
 
 class SerialSampler(BaseSampler):
     """The simplest sampler; no parallelism, everything occurs in same, master
@@ -341,9 +597,10 @@ class SerialSampler(BaseSampler):
     """
 
     def __init__(self, *args, CollectorCls=CpuResetCollector,
-            eval_CollectorCls=SerialEvalCollector, **kwargs):
+            eval_CollectorCls=SerialEvalCollector, eval_collector_kwargs=None, **kwargs):
         super().__init__(*args, CollectorCls=CollectorCls,
             eval_CollectorCls=eval_CollectorCls, **kwargs)
+        self.eval_collector_kwargs = eval_collector_kwargs or dict()
 
     def initialize(
             self,
@@ -387,16 +644,7 @@ class SerialSampler(BaseSampler):
             env_ranks=env_ranks,  # Might get applied redundantly to agent.
         )
         if self.eval_n_envs > 0:  # May do evaluation.
-            eval_envs = [self.EnvCls(id=i, **self.eval_env_kwargs)
-                for i in range(self.eval_n_envs)]
-            eval_CollectorCls = self.eval_CollectorCls or SerialEvalCollector
-            self.eval_collector = eval_CollectorCls(
-                envs=eval_envs,
-                agent=agent,
-                TrajInfoCls=self.TrajInfoCls,
-                max_T=self.eval_max_steps // self.eval_n_envs,
-                max_trajectories=self.eval_max_trajectories,
-            )
+            self.initialize_eval(agent)
 
         agent_inputs, traj_infos = collector.start_envs(
             self.max_decorrelation_steps)
@@ -411,6 +659,20 @@ class SerialSampler(BaseSampler):
         logger.log("Serial Sampler initialized.")
         return examples
 
+    def initialize_eval(self, agent):
+        """Instantiate the evaluation environments and evaluation Collector."""
+        eval_envs = [self.EnvCls(id=i, **self.eval_env_kwargs)
+            for i in range(self.eval_n_envs)]
+        eval_CollectorCls = self.eval_CollectorCls or SerialEvalCollector
+        self.eval_collector = eval_CollectorCls(
+            envs=eval_envs,
+            agent=agent,
+            TrajInfoCls=self.TrajInfoCls,
+            max_T=self.eval_max_steps // self.eval_n_envs,
+            max_trajectories=self.eval_max_trajectories,
+            **self.eval_collector_kwargs,
+        )
+
     def obtain_samples(self, itr):
         """Call the collector to execute a batch of agent-environment interactions.
         Return data in torch tensors, and a list of trajectory-info objects from
@@ -427,3 +689,192 @@ class SerialSampler(BaseSampler):
     def evaluate_agent(self, itr):
         """Call the evaluation collector to execute agent-environment interactions."""
         return self.eval_collector.collect_evaluation(itr)
+
+    def shutdown(self):
+        if hasattr(getattr(self, "eval_collector", None), "shutdown"):
+            self.eval_collector.shutdown()
+
+
+StepBuffer = namedarraytuple("StepBuffer", ["observation", "action", "reward"])
+
+
+def parallel_sampler_worker(EnvCls, env_kwargs, env_ids, TrajInfoCls, batch_T,
+                            samples_np, step_np, ctrl, conn):
+    """Worker loop of ``ParallelSampler``: steps its slice of environments once
+    per master step, writing results directly into the shared buffers, and
+    sends back the trajectory infos completed during each batch.  On an
+    error, sends its traceback instead and aborts the barriers, so that the
+    master (and the other workers) stop waiting."""
+    try:
+        envs = [EnvCls(id=b, **env_kwargs) for b in env_ids]
+        traj_infos = [TrajInfoCls() for _ in envs]
+        for b, env in zip(env_ids, envs):
+            step_np.observation[b] = env.reset()
+        completed_infos = list()
+        ctrl.barrier_out.wait()
+        while True:
+            ctrl.barrier_in.wait()
+            if ctrl.quit.value:
+                break
+            t = ctrl.t.value
+            for i, (b, env) in enumerate(zip(env_ids, envs)):
+                action = step_np.action[b]
+                o, r, d, env_info = env.step(action)
+                traj_infos[i].step(step_np.observation[b], action, r, d, None, env_info)
+                if getattr(env_info, "traj_done", d):
+                    completed_infos.append(traj_infos[i].terminate(o))
+                    traj_infos[i] = TrajInfoCls()
+                    o = env.reset()
+                step_np.observation[b] = o
+                step_np.reward[b] = r
+                samples_np.env.done[t, b] = d
+                if env_info:
+                    samples_np.env.env_info[t, b] = env_info
+            ctrl.barrier_out.wait()
+            if t == batch_T - 1:
+                conn.send(completed_infos)
+                completed_infos = list()
+        for env in envs:
+            env.close()
+    except threading.BrokenBarrierError:
+        pass  # Aborted by another worker, whose error the master raises.
+    except BaseException:
+        conn.send(traceback.format_exc())  # Before the abort: there when the master looks.
+        ctrl.barrier_in.abort()
+        ctrl.barrier_out.abort()
+
+
+class ParallelSampler(SerialSampler):
+    """Same interface as ``SerialSampler``, but the ``batch_B`` training
+    environments are stepped in ``n_workers`` subprocesses, each owning a
+    contiguous slice of them.  Workers write observations, rewards and dones
+    straight into shared-memory sample buffers, so the master process only
+    runs batched agent inference.  Evaluation still runs in the master.
+    NOTE: ``max_decorrelation_steps`` is not supported.
+    """
+
+    def __init__(self, *args, n_workers=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_workers = n_workers
+
+    def initialize(
+            self,
+            agent,
+            affinity=None,
+            seed=None,
+            bootstrap_value=False,
+            traj_info_kwargs=None,
+            rank=0,
+            world_size=1,
+            ):
+        """Like ``SerialSampler.initialize()``, but forks the env workers
+        instead of building a collector in the master process."""
+        B = self.batch_spec.B
+        global_B = B * world_size
+        env_ranks = list(range(rank * B, (rank + 1) * B))
+        example_env = self.EnvCls(id=0, **self.env_kwargs)
+        agent.initialize(example_env.spaces, share_memory=False,
+            global_B=global_B, env_ranks=env_ranks)
+        samples_pyt, samples_np, examples = build_samples_buffer(agent, example_env,
+            self.batch_spec, bootstrap_value, agent_shared=False,
+            env_shared=True, subprocess=False)
+        if traj_info_kwargs:
+            for k, v in traj_info_kwargs.items():
+                setattr(self.TrajInfoCls, "_" + k, v)  # Avoid passing at init.
+        # Latest observation, action and reward of every env.
+        step_np = StepBuffer(
+            observation=buffer_from_example(examples["observation"], B, share_memory=True),
+            action=buffer_from_example(examples["action"], B, share_memory=True),
+            reward=buffer_from_example(examples["reward"], B, share_memory=True),
+        )
+        step_np.action[:] = example_env.action_space.null_value()
+        step_np.reward[:] = 0
+        example_env.close()
+
+        n_workers = min(self.n_workers, B)
+        ctx = mp.get_context("fork")
+        self.ctrl = AttrDict(
+            quit=ctx.RawValue(ctypes.c_bool, False),
+            t=ctx.RawValue("l", 0),
+            barrier_in=ctx.Barrier(n_workers + 1),
+            barrier_out=ctx.Barrier(n_workers + 1),
+        )
+        self.workers, self.conns = list(), list()
+        for env_ids in np.array_split(np.arange(B), n_workers):
+            conn, worker_conn = ctx.Pipe(duplex=False)
+            w = ctx.Process(target=parallel_sampler_worker,
+                args=(self.EnvCls, self.env_kwargs, list(env_ids), self.TrajInfoCls,
+                      self.batch_spec.T, samples_np, step_np, self.ctrl, worker_conn),
+                daemon=True)
+            w.start()
+            self.workers.append(w)
+            self.conns.append(conn)
+        self._wait(self.ctrl.barrier_out)  # Workers have reset their envs.
+
+        if self.eval_n_envs > 0:  # May do evaluation.
+            self.initialize_eval(agent)
+
+        agent.collector_initialize(global_B=global_B, env_ranks=env_ranks)
+        agent.reset()
+        agent.sample_mode(itr=0)
+
+        self.agent = agent
+        self.samples_pyt = samples_pyt
+        self.samples_np = samples_np
+        self.step_np = step_np
+        self.step_pyt = torchify_buffer(step_np)
+        logger.log(f"Parallel Sampler initialized with {n_workers} env workers.")
+        return examples
+
+    def obtain_samples(self, itr):
+        """Run batched agent inference in the master while the workers step
+        the environments.  Return data in torch tensors, and a list of
+        trajectory-info objects from episodes which ended.
+        """
+        agent_buf, env_buf = self.samples_np.agent, self.samples_np.env
+        step_np, step_pyt = self.step_np, self.step_pyt
+        agent_buf.prev_action[0] = step_np.action  # Leading prev_action.
+        env_buf.prev_reward[0] = step_np.reward
+        self.agent.sample_mode(itr)
+        for t in range(self.batch_spec.T):
+            env_buf.observation[t] = step_np.observation
+            action, agent_info = self.agent.step(*step_pyt)
+            step_np.action[:] = action
+            self.ctrl.t.value = t
+            self._wait(self.ctrl.barrier_in)
+            # Workers step their envs here.
+            self._wait(self.ctrl.barrier_out)
+            for b in np.flatnonzero(env_buf.done[t]):
+                self.agent.reset_one(idx=b)
+            agent_buf.action[t] = step_np.action
+            env_buf.reward[t] = step_np.reward
+            if agent_info:
+                agent_buf.agent_info[t] = agent_info
+
+        if "bootstrap_value" in agent_buf:
+            agent_buf.bootstrap_value[:] = self.agent.value(*step_pyt)
+
+        completed_infos = list()
+        for conn in self.conns:
+            completed_infos.extend(conn.recv())
+        return self.samples_pyt, completed_infos
+
+    def _wait(self, barrier):
+        """``barrier.wait()``, raising the error of a worker which aborted it."""
+        try:
+            barrier.wait()
+        except threading.BrokenBarrierError:
+            for conn in self.conns:
+                while conn.poll():
+                    msg = conn.recv()
+                    if isinstance(msg, str):  # Traceback, not trajectory infos.
+                        raise RuntimeError(f"Env worker failed:\n{msg}") from None
+            raise
+
+    def shutdown(self):
+        self.ctrl.quit.value = True
+        if not self.ctrl.barrier_in.broken:  # Else the workers have exited.
+            self.ctrl.barrier_in.wait()
+        for w in self.workers:
+            w.join()
+        super().shutdown()
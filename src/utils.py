@@ -1,4 +1,12 @@
 from rlpyt.experiments.configs.atari.dqn.atari_dqn import configs
+import atexit
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+import torch
 
 
 def count_parameters(model):
@@ -13,6 +21,136 @@ class dummy_context_mgr:
         return False
 
 
+class PhaseTimer:
+    """Records the wall-clock time of named phases, e.g.
+    ``with timer.phase("Sample"): ...``, over a rolling window of the last
+    ``window`` occurrences of each.  When disabled, ``phase()`` returns a
+    shared ``dummy_context_mgr``.  With ``cuda_sync``, CUDA is synchronized
+    at phase boundaries, so that asynchronous kernels are charged to the
+    phase which launched them (this slows training down a little).  A phase
+    opened with ``split=True`` inside another is carved out of it: the
+    enclosing phase's time excludes it (its own enclosing ones' does not).
+    """
+
+    def __init__(self, enabled=False, cuda_sync=False, window=1000):
+        self.enabled = enabled
+        self.cuda_sync = cuda_sync and torch.cuda.is_available()
+        self.window = window
+        self.durations = dict()
+        self._split = list()  # Time split off each open phase.
+        self._dummy = dummy_context_mgr()
+
+    def phase(self, name, split=False):
+        return self._timed(name, split) if self.enabled else self._dummy
+
+    @contextmanager
+    def _timed(self, name, split=False):
+        if self.cuda_sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        self._split.append(0.)
+        try:
+            yield
+        finally:
+            if self.cuda_sync:
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start
+            duration = elapsed - self._split.pop()
+            if split and self._split:
+                self._split[-1] += elapsed
+            if name not in self.durations:
+                self.durations[name] = deque(maxlen=self.window)
+            self.durations[name].append(duration)
+
+    def stats(self):
+        """Rolling mean and percentiles of each phase, in milliseconds."""
+        stats = dict()
+        for name, durations in self.durations.items():
+            ms = 1000 * np.array(durations)
+            stats[name + "Mean"] = ms.mean()
+            for q in (50, 90, 99):
+                stats[name + "P{}".format(q)] = np.percentile(ms, q)
+        return stats
+
+
+class ScalarAccumulator:
+    """Collects the scalars of each update (losses, gradient norms, ...) as
+    tensors, on whatever device they were computed, and copies them to the
+    host together in ``values()``: one synchronization per device, instead
+    of an ``.item()`` per scalar per update.  ``extend()`` collects vectors
+    (e.g. TD errors) the same way.
+    """
+
+    def __init__(self):
+        self.entries = list()  # (name, tensor or number, is_vector)
+
+    def append(self, **scalars):
+        for name, value in scalars.items():
+            self.entries.append((name, _detach(value), False))
+
+    def extend(self, **vectors):
+        for name, value in vectors.items():
+            self.entries.append((name, _detach(value), True))
+
+    def values(self):
+        """Dict of name -> list of floats, in the order collected."""
+        by_device = dict()
+        for _, value, _ in self.entries:
+            if torch.is_tensor(value):
+                by_device.setdefault(value.device, []).append(value.reshape(-1).float())
+        host = {device: iter(torch.cat(tensors).cpu().split([len(t) for t in tensors]))
+                for device, tensors in by_device.items()}
+        values = dict()
+        for name, value, is_vector in self.entries:
+            if torch.is_tensor(value):
+                value = next(host[value.device]).tolist()  # Flat: scalars have length 1.
+            elif not is_vector:
+                value = [value]
+            values.setdefault(name, []).extend(float(v) for v in value)
+        self.entries = list()
+        return values
+
+
+def _detach(value):
+    return value.detach() if torch.is_tensor(value) else value
+
+
+class CsvWriter:
+    """Appends rows to a csv file in the same format as
+    ``np.savetxt(path, rows, delimiter=",", header=header)``, so that it can be
+    read back with ``np.loadtxt(path, delimiter=",", skiprows=1)``.
+
+    Rows are buffered and written (and fsynced) at most every
+    ``flush_interval`` seconds, and at exit.  Each flush writes whole rows
+    only, so after a crash the file holds every row up to the last flush.
+    """
+
+    def __init__(self, path, header, flush_interval=10.):
+        self.flush_interval = flush_interval
+        self.file = open(path, "w")
+        self.file.write("# " + header + "\n")
+        self.rows = list()
+        self.flush()
+        atexit.register(self.close)
+
+    def write(self, row):
+        self.rows.append(",".join("%.18e" % x for x in row) + "\n")
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.file.write("".join(self.rows))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.rows = list()
+        self.last_flush = time.time()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+
 def set_config(args, game):
     # TODO: Use Hydra to manage configs
     config = configs['ernbw']
@@ -26,6 +164,8 @@ def set_config(args, game):
     config['eval_env']['imagesize'] = args.imagesize
     config['env']['seed'] = args.seed
     config['eval_env']['seed'] = args.seed
+    config['env']['reset_cache_size'] = args.reset_cache_size
+    config['eval_env']['reset_cache_size'] = args.reset_cache_size
     config["model"]["dueling"] = bool(args.dueling)
     config["algo"]["min_steps_learn"] = args.min_steps_learn
     config["algo"]["n_step_return"] = args.n_step
@@ -86,6 +226,13 @@ def set_config(args, game):
     config["algo"]["distributional"] = args.distributional
     config["algo"]["delta_clip"] = args.delta_clip
     config["algo"]["prioritized_replay"] = args.prioritized_replay
+    config["algo"]["prefetch_batches"] = args.prefetch_batches
+    config["algo"]["replay_frame_codec"] = args.replay_frame_codec
+    config["algo"]["replay_dir"] = args.replay_dir or None
+    config["algo"]["replay_reopen"] = args.replay_reopen
+    config["algo"]["flat_sum_tree"] = args.flat_sum_tree
+    config["algo"]["replay_frame_views"] = args.replay_frame_views
+    config["algo"]["replay_sample_batches"] = args.replay_sample_batches
 
     # New arguments for testing different self-supervised losses with/without dynamics model
     config["model"]['spr_loss_type'] = args.spr_loss_type
@@ -94,6 +241,9 @@ def set_config(args, game):
     config["model"]['repeat_type'] = args.repeat_type
     config["model"]['repeat_coefficient'] = args.repeat_coefficient
     config["algo"]['repeat_type'] = args.repeat_type
+    config["algo"]['hash_count_latent'] = args.hash_count_latent
+    config["algo"]['aug_policy_update'] = args.aug_policy_update
+    config["algo"]['aug_policy_interval'] = args.aug_policy_interval
     config["agent"]['repeat_type'] = args.repeat_type
 
     return config
\ No newline at end of file